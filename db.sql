@@ -1,4 +1,4 @@
-create table settings (
+create table if not exists settings (
     phone_server TEXT,
     mysql_host TEXT,
     mysql_user TEXT,
@@ -9,15 +9,67 @@ create table settings (
     model_misc TEXT
 );
 
-create table users (
+create table if not exists users (
     username VARCHAR(50),
     password VARCHAR(50),
     permissions INT
 );
 
-create table ext_mac_map (
+create table if not exists ext_mac_map (
     extension TEXT,
     mac VARCHAR(12),
     template TEXT,
-    misc TEXT
+    misc TEXT,
+    backend TEXT
+);
+
+create index if not exists ext_mac_map_mac on ext_mac_map (mac);
+
+create table if not exists backends (
+    name TEXT,
+    mysql_host TEXT,
+    mysql_user TEXT,
+    mysql_pass TEXT,
+    mysql_db TEXT,
+    ext_start TEXT,
+    ext_end TEXT
+);
+
+create table if not exists change_log (
+    created REAL,
+    dependency TEXT
+);
+
+create table if not exists fetch_log (
+    mac VARCHAR(12),
+    fetched REAL,
+    elapsed REAL
+);
+
+create table if not exists ami_settings (
+    backend TEXT,
+    host TEXT,
+    port INT,
+    username TEXT,
+    secret TEXT,
+    channel_driver TEXT
+);
+
+create table if not exists jobs (
+    kind TEXT,
+    params TEXT,
+    state TEXT,
+    done INT,
+    total INT,
+    message TEXT,
+    checkpoint TEXT,
+    created REAL,
+    heartbeat REAL,
+    runner TEXT
+);
+
+create table if not exists phone_lines (
+    mac VARCHAR(12),
+    line INT,
+    extension TEXT
 );
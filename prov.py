@@ -13,40 +13,153 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+import hashlib
+import io
+import itertools
 import json
 import os
+import random
+import re
+import socket
 import sqlite3
+import struct
 import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from hashlib import pbkdf2_hmac
-from beaker.middleware import SessionMiddleware
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from jinja2 import Environment, FileSystemLoader, FunctionLoader, TemplateNotFound, Undefined, meta, nodes
+from jinja2.ext import Extension
+
+class LazyModule(object):
+    """Stands in for a module and imports it on first attribute access
+
+    Used to defer importing the MySQL driver until FreePBX is first queried.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            __import__(self._name)
+            self._module = sys.modules[self._name]
+        return getattr(self._module, attr)
+
 if sys.version_info.major == 2:
     VERSION_MAJOR = 2
     FileNotFoundError = IOError
-    import MySQLdb as mysql
+    mysql = LazyModule('MySQLdb')
     from urlparse import parse_qs
 elif sys.version_info.major == 3:
     VERSION_MAJOR = 3
-    import mysql.connector as mysql
+    mysql = LazyModule('mysql.connector')
     from urllib.parse import parse_qs
 else:
     print('Must be either Python2 or Python3')
     sys.exit(1)
 
+_MYSQL_ERRORS = []
+
+def mysql_errors():
+    """Returns the exception types to catch MySQL driver errors with
+
+    Resolved once, when an except clause first needs it, so the driver is
+    still imported lazily. Empty when the driver is not installed, so other
+    exceptions are not turned into an ImportError.
+
+    :rtype tuple
+    """
+
+    if not _MYSQL_ERRORS:
+        try:
+            _MYSQL_ERRORS.append((mysql.Error, ))
+        except ImportError:
+            _MYSQL_ERRORS.append(())
+    return _MYSQL_ERRORS[0]
+
 APP_TITLE = 'Phone Provisioner'
 SQLITE_DB = os.path.join(os.path.dirname(__file__), 'prov.db')
 TEMPLATES_FOLDER = os.path.join(os.path.dirname(__file__), 'templates')
 TEMPLATE_ENV = Environment(loader=FileSystemLoader(TEMPLATES_FOLDER))
+REPLICA_BUNDLE_DIR = os.path.join(os.path.dirname(__file__), 'bundles')
 SALT_LEN = 32
+MYSQL_POOL_SIZE = 5
+MYSQL_POOL_IDLE = 300
+MYSQL_CONNECT_TIMEOUT = 3
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 30
+CREDENTIAL_CACHE_TTL = 60
+PBX_BATCH_SIZE = 500
+SETTINGS_COLUMNS = ('phone_server', 'mysql_host', 'mysql_user', 'mysql_pass', 'mysql_db', 'static_folder', 'ntp_server', 'model_misc')
+ROUTE_CACHE_TTL = 10
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+TFTP_BLKSIZE = 512
+TFTP_MAX_BLKSIZE = 65464
+TFTP_TIMEOUT = 2
+TFTP_RETRIES = 5
+TFTP_RENDER_THREADS = 16
+DIRECTORY_REFRESH = 300
+PHONEBOOK_TEMPLATE = 'phonebook.template'
+NEGATIVE_CACHE_TTL = 30
+NEGATIVE_CACHE_SIZE = 10000
+MISS_RATE = 1
+MISS_BURST = 20
+RENDER_CACHE_SIZE = 20000
+RENDER_CACHE_TTL = 3600
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE_BYTES = 64 * 1024 * 1024
+FRAGMENT_CACHE_TTL = 3600
+RENDER_SHARE_DIR = None
+RENDER_SHARE_LOCKS = 64
+SINGLE_FLIGHT_TTL = 5
+CHANGE_POLL_INTERVAL = 1
+CHANGE_LOG_RETENTION = 86400
+FETCH_FLUSH_INTERVAL = 2
+RESYNC_RATE = 5
+RESYNC_MIN_RATE = 0.5
+RESYNC_MAX_RATE = 50
+RESYNC_RATE_STEP = 1
+RESYNC_WAVE = 10
+RESYNC_JITTER = 0.5
+RESYNC_TARGET_LATENCY = 0.5
+RESYNC_COMPLETION_TIMEOUT = 300
+JOB_THREADS = 2
+JOB_POLL_INTERVAL = 5
+JOB_STALE = 60
+JOB_BATCH = 200
+WARMUP = True
+WARMUP_TIMEOUT = 30
+BUNDLE_FORMAT = 1
+BUNDLE_POLL_INTERVAL = 5
+EXT_MAC_MAP_COLUMNS = ('extension', 'mac', 'template', 'misc', 'backend')
+STREAM_CHUNK_SIZE = 65536
+TEXT_TYPES = (bytes, type(u''))
+RE_COMMENT_PATTERN = r'\(\?#(?P<templatefile>[^\(\)]*)\)\(\?#(?P<format>[^\(\)]*)\)$'
 
 STATUS = {
     'OK': '200 OK',
+    'Not Modified': '304 Not Modified',
+    'Bad Request': '400 Bad Request',
+    'Unauthorized': '401 Unauthorized',
     'Forbidden': '403 Forbidden',
     'Not Found': '404 Not Found',
+    'Method Not Allowed': '405 Method Not Allowed',
+    'Conflict': '409 Conflict',
+    'Precondition Failed': '412 Precondition Failed',
     'Redirect': '302 Found',
+    'Too Many Requests': '429 Too Many Requests',
     'ISE': '500 Internal Server Error',
+    'Service Unavailable': '503 Service Unavailable',
 }
 
+STALE_WARNING = ('Warning', '110 - "Response is Stale"')
+
 HEADER = {
     'html': ('Content-type', 'text/html'),
     "css": ("Content-type", "text/css"),
@@ -61,14 +174,61 @@ HEADER = {
 }
 
 
+def to_bytes(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+def coalesce_chunks(chunks, size=None):
+    """Joins small text or bytes chunks, such as Template.generate() output, into chunks of about size bytes"""
+
+    size = size or STREAM_CHUNK_SIZE
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        chunk = to_bytes(chunk)
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield b''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield b''.join(buf)
+
+def start_stream(chunks, size=None):
+    """Renders the first size bytes of chunks now and leaves the rest to stream
+
+    Errors near the start of a template are raised here, while a 500 can still
+    be sent, instead of after the 200 has gone out. Output shorter than size
+    is returned whole, so only large templates end up streamed.
+
+    :return The whole output, or an iterable of the first chunk and the rest
+    :rtype bytes or iterable
+    """
+
+    size = size or STREAM_CHUNK_SIZE
+    chunks = iter(chunks)
+    head = []
+    buffered = 0
+    for chunk in chunks:
+        chunk = to_bytes(chunk)
+        head.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            return itertools.chain([b''.join(head)], chunks)
+    return b''.join(head)
+
 class AppResponse(object):
     """Object to hold html, response status, and response headers in one place"""
 
     def __init__(self, html_string, status=STATUS['OK'], header=[ HEADER['html'] ]):
         """Init function
 
-        :param html_string The text string (or binary data) to be the body of the response
-        :type html_string str or bytes
+        :param html_string The body of the response. Text and binary data are sent
+            as is, file objects and other iterables (like Template.generate())
+            are streamed in chunks of about STREAM_CHUNK_SIZE bytes.
+        :type html_string str, bytes, file or iterable
         :param status Response status
         :type status str
         :param header List of tuples that represent the reponse headers
@@ -84,6 +244,38 @@ class AppResponse(object):
     def get_html(self):
         return self.html_string
 
+    def content_length(self):
+        """Returns the body length in bytes, or None when it is only known once streamed"""
+
+        body = self.html_string
+        if isinstance(body, TEXT_TYPES):
+            return len(to_bytes(body))
+        if hasattr(body, 'fileno'):
+            try:
+                return os.fstat(body.fileno()).st_size - body.tell()
+            except (AttributeError, IOError, OSError):
+                return None
+        return None
+
+    def iter_body(self):
+        """Yields the body as bytes chunks, closing a file body at the end"""
+
+        body = self.html_string
+        if isinstance(body, TEXT_TYPES):
+            yield to_bytes(body)
+        elif hasattr(body, 'read'):
+            try:
+                while True:
+                    chunk = body.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield to_bytes(chunk)
+            finally:
+                body.close()
+        else:
+            for chunk in coalesce_chunks(body):
+                yield chunk
+
     def get_status(self):
         return self.status
 
@@ -249,9 +441,7 @@ def submit_setup(environ):
     if request_method != 'POST':
         return AppResponse('', STATUS['Redirect'], [ ('Location', base_path) ])
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         db.execute('SELECT * FROM settings')
         db.close()
         return AppResponse('<div class="header">Database alread set up!</div>', STATUS['Forbidden'])
@@ -301,9 +491,7 @@ def get_index(environ):
     """
 
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         db.execute('SELECT * FROM settings')
         db.close()
     except IOError:
@@ -428,6 +616,14 @@ function change_select(sel_id) {
   models_elem.style.display = "inline";
 }
 
+// Pages showing running jobs include a poll element to refresh themselves
+setInterval(function() {
+  var poll = document.getElementById('poll');
+  if (poll) {
+    ajax_request(poll.dataset.url);
+  }
+}, 2000);
+
 function get_model_globals(url) {
   // console.log(document.getElementById('model_globals').value);
   var model = document.getElementById('model_globals').value;
@@ -440,6 +636,10 @@ function get_model_globals(url) {
 <div class="menu">
   <span onclick="ajax_request('{base_url}/global-settings')">Global Settings</span>
   <span onclick="ajax_request('{base_url}/phone-list')">Phone List</span>
+  <span onclick="ajax_request('{base_url}/bulk-edit')">Bulk Edit</span>
+  <span onclick="ajax_request('{base_url}/pbx-backends')">PBX Backends</span>
+  <span onclick="ajax_request('{base_url}/resync')">Resync</span>
+  <span onclick="ajax_request('{base_url}/jobs')">Jobs</span>
   <span onclick="ajax_request('{base_url}/account')">Account</span>
   <span onclick="ajax_request('{base_url}/logout')">Log Out</span>
 </div>
@@ -469,9 +669,7 @@ def get_admin(environ):
         user = post_input.get('user', [''])[0]
         pwd = post_input.get('pwd', [''])[0]
         try:
-            db = sqlite3.connect(SQLITE_DB)
-            if VERSION_MAJOR == 2:
-                db.text_factory = str
+            db = connect_db()
             c = db.execute('SELECT password FROM users WHERE username=?', (user, ))
             password = c.fetchone()
             if password is None or not compare_hash(pwd, password[0]):
@@ -496,9 +694,7 @@ def get_admin(environ):
         return AppResponse('{}<div class="header">Forbidden!</div>'.format(get_def_head()), STATUS['Forbidden'])
 
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         db.execute('SELECT * FROM settings')
     except IOError as e:
         print(e)
@@ -532,9 +728,7 @@ def get_global_settings(environ):
         return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         toast = ''
         if request_method == 'POST':
             raw_post = environ.get('wsgi.input', '')
@@ -547,13 +741,10 @@ def get_global_settings(environ):
             static_folder = post_input.get('static_folder', [''])[0]
             ntp_server = post_input.get('ntp_server', [''])[0]
             if phone_server:
-                query = '''UPDATE settings SET
-                     phone_server=?, mysql_host=?, mysql_user=?, mysql_pass=?, mysql_db=?, static_folder=?, ntp_server=?
-                     WHERE rowid=1'''
                 values = phone_server, mysql_host, mysql_user, mysql_pass, mysql_db, static_folder, ntp_server
-                db.execute(query, values)
+                changes = update_settings(db, dict(zip(SETTINGS_COLUMNS, values)))
                 db.commit()
-                toast = '<div class="message">Update Successful!</div>'
+                toast = '<div class="message">Update Successful! {}</div>'.format(affected_message(db, changes))
 
         c = db.execute('SELECT * FROM settings')
         settings = c.fetchone()
@@ -616,6 +807,27 @@ def get_global_settings(environ):
 '''.format(**string_format)
     return AppResponse(html_string)
 
+def update_settings(db, settings):
+    """Saves the global settings in the open transaction and logs what changed
+
+    :param settings Every settings column except model_misc
+    :type settings dict
+    :return Changed dependency tuples
+    :rtype list
+    """
+
+    old_settings = db.execute('SELECT * FROM settings').fetchone()
+    query = '''UPDATE settings SET
+         phone_server=?, mysql_host=?, mysql_user=?, mysql_pass=?, mysql_db=?, static_folder=?, ntp_server=?
+         WHERE rowid=1'''
+    values = [settings[column] for column in SETTINGS_COLUMNS[:-1]]
+    db.execute(query, values)
+    changes = [('setting', column) for column, old, new in zip(SETTINGS_COLUMNS, old_settings, values) if old != new]
+    if any(column.startswith('mysql_') for _setting, column in changes):
+        changes.append(('backends', ))
+    record_change(db, changes)
+    return changes
+
 def get_model_globals(environ):
     request_method = environ.get('REQUEST_METHOD', '')
     base_url = environ.get('SCRIPT_NAME', '')
@@ -648,9 +860,7 @@ def get_model_globals(environ):
 def model_global_settings(model, post=None):
     message = ''
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         c = db.execute('SELECT model_misc FROM settings')
         model_misc = c.fetchone()[0]
         try:
@@ -660,8 +870,10 @@ def model_global_settings(model, post=None):
         if post:
             model_misc[model] = post
             db.execute('UPDATE settings SET model_misc=? WHERE rowid=1', (json.dumps(model_misc), ))
-            message = 'Update Successful!'
+            changes = [('model_misc', model)]
+            record_change(db, changes)
             db.commit()
+            message = 'Update Successful! {}'.format(affected_message(db, changes))
         db.close()
     except IOError as e:
         db.close()
@@ -686,9 +898,7 @@ def get_phone_list(environ):
         return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         if request_method == 'POST':
             #print('POST')
             raw_post = environ.get('wsgi.input', '')
@@ -697,10 +907,15 @@ def get_phone_list(environ):
             if typ == 'add':
                 ext = post_input.get('ext', [''])[0]
                 mac = post_input.get('mac', [''])[0].replace(':', '').lower()
-                db.execute('INSERT INTO ext_mac_map VALUES (?, ?, ?, ?)', (ext, mac, '', ''))
+                db.execute('INSERT INTO ext_mac_map (extension, mac, template, misc, backend) VALUES (?, ?, ?, ?, ?)', (ext, mac, '', '', ''))
+                record_change(db, [('phone', mac)])
                 db.commit()
             elif typ == 'del':
                 rowid = post_input.get('rowid', [''])[0]
+                c = db.execute('SELECT mac FROM ext_mac_map WHERE rowid=?', (rowid, ))
+                macs = [r[0] for r in c.fetchall()]
+                record_change(db, [('phone', mac) for mac in macs])
+                db.executemany('DELETE FROM phone_lines WHERE mac=?', [(mac, ) for mac in macs])
                 db.execute('DELETE FROM ext_mac_map WHERE rowid=?', (rowid, ))
                 db.commit()
         c = db.execute('SELECT rowid,* FROM ext_mac_map ORDER BY extension')
@@ -765,43 +980,45 @@ def edit_phone(environ):
     rowid = post_input.get('rowid', [''])[0]
     toast = ''
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
+        db = connect_db()
         ex = post_input.get('ext', [])
         ma = post_input.get('mac', [])
+        be = post_input.get('backend', [''])[0]
         model = post_input.get('model', [''])
         model = list(filter(lambda m: m != 'Choose a Model', model))
         clear_template = post_input.get('clear_template', [])
         model_post = get_model_post(post_input)
+        c = db.execute('SELECT * FROM ext_mac_map WHERE rowid=?', (rowid, ))
+        phone = phone_from_row(c.fetchone())
+        old_mac = phone['mac']
+        phone_changes = [('phone', phone['mac'])]
         if ex:
-            ex = ex[0]
-            ma = ma[0].replace(':', '').lower()
-            db.execute('UPDATE ext_mac_map SET extension=?, mac=? WHERE rowid=?', (ex, ma, rowid))
+            phone['extension'] = ex[0]
+            phone['mac'] = ma[0].replace(':', '').lower()
+            phone['backend'] = be
             if len(model) > 0 and model[0]:
-                #print(model)
-                model = model[0]
-                db.execute('UPDATE ext_mac_map SET template=? WHERE rowid=?', (model, rowid))
-            db.commit()
+                phone['template'] = model[0]
             toast = '<div class="message">Update Successful!</div>'
         if clear_template:
-            clear_template = clear_template[0]
-            db.execute('UPDATE ext_mac_map SET template=? WHERE rowid=?', ('', rowid))
-            db.commit()
-        c = db.execute('SELECT * FROM ext_mac_map WHERE rowid=?', (rowid, ))
-        phone = c.fetchone()
-        ext = phone[0]
-        mac = phone[1]
-        template = phone[2]
-        misc = phone[3]
-        try:
-            misc_dict = json.loads(misc)
-        except ValueError:
-            misc_dict = {}
+            phone['template'] = ''
         if model_post:
-            misc_dict[template] = model_post
-            db.execute('UPDATE ext_mac_map SET misc=? WHERE rowid=?', (json.dumps(misc_dict), rowid))
+            phone['misc'][phone['template']] = model_post
+        if ex or clear_template or model_post:
+            db.execute('UPDATE ext_mac_map SET extension=?, mac=?, template=?, misc=?, backend=? WHERE rowid=?',
+                       (phone['extension'], phone['mac'], phone['template'], json.dumps(phone['misc']), phone['backend'], rowid))
+            if ex:
+                set_phone_lines(db, phone['mac'], post_input.get('lines', [''])[0].replace(',', ' ').split(), old_mac)
+            phone_changes.append(('phone', phone['mac']))
+            record_change(db, phone_changes)
             db.commit()
+        ext = phone['extension']
+        mac = phone['mac']
+        template = phone['template']
+        misc_dict = phone['misc']
+        misc = json.dumps(misc_dict)
+        phone_backend = phone['backend']
+        lines = get_phone_lines(db, [mac])[mac]
+        backends = get_backends(db)
         db.close()
     except IOError as e:
         db.close()
@@ -841,6 +1058,9 @@ def edit_phone(environ):
             'ext': ext,
             'mac': mac,
             'misc': misc,
+            'lines': ', '.join(lines),
+            'backend_options': ''.join(['<option value="{0}"{1}>{0}</option>'.format(b['name'], ' selected' if b['name'] == phone_backend else '')
+                                        for b in backends[1:]]),
             'template_html': template_html,
     }
     html_string = '''\
@@ -849,7 +1069,9 @@ def edit_phone(environ):
 <div class="header">Edit {ext}</div>
 <input type="hidden" name="rowid" value="{rowid}" />
 EXT: <input name="ext" value="{ext}" required />
-MAC: <input name="mac" value="{mac}" required /><br />
+MAC: <input name="mac" value="{mac}" required />
+PBX: <select name="backend"><option value="">Auto</option>{backend_options}</select><br />
+Extra Lines: <input name="lines" value="{lines}" placeholder="Extensions for lines 2, 3, ..." /><br />
 {template_html}
 </form>
 '''.format(**string_template)
@@ -863,6 +1085,8 @@ def get_model_post(post_input):
     post_input.pop('mac', None)
     post_input.pop('model', None)
     post_input.pop('clear_template', None)
+    post_input.pop('backend', None)
+    post_input.pop('lines', None)
 
     return post_input
 
@@ -908,9 +1132,7 @@ def get_account(environ):
             new_pw1 = post_input.get('new_pw1', [''])[0]
             new_pw2 = post_input.get('new_pw2', [''])[0]
             try:
-                db = sqlite3.connect(SQLITE_DB)
-                if VERSION_MAJOR == 2:
-                    db.text_factory = str
+                db = connect_db()
                 c = db.execute('SELECT * FROM users WHERE username=?', (user, ))
                 r = c.fetchone()
                 pw = r[1]
@@ -957,242 +1179,3376 @@ def get_account(environ):
 
     return AppResponse(html_string)
 
-def get_logout(environ):
+def get_pbx_backends(environ):
+    request_method = environ.get('REQUEST_METHOD', '')
     base_url = environ.get('SCRIPT_NAME', '')
     session = environ['beaker.session']
-    session['is_authed'] = None
-    session['user'] = None
-    session.save()
-    return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
-
-def check_brand_urls(environ):
-    #print(environ['PATH_INFO'])
-    path_info = environ.get('PATH_INFO', '')
-    try:
-        walk_g = os.walk(TEMPLATES_FOLDER)
-        brands = next(walk_g)[1]
-    except StopIteration:
-        return
-
-    for brand in brands:
-        brand_folder = os.path.join(TEMPLATES_FOLDER, brand)
-        brand_walk_g = os.walk(brand_folder)
-        models = next(brand_walk_g)[1]
-        for model in models:
-            fn = os.path.join(TEMPLATES_FOLDER, brand, model, 'urls')
-            try:
-                with open(fn, 'r') as urls_file:
-                    urls = urls_file.readlines()
-            except FileNotFoundError:
-                continue
-            
-            import re
-            re_comment_pattern = r'\(\?#(?P<templatefile>[^\(\)]*)\)\(\?#(?P<format>[^\(\)]*)\)$'
-            for url in urls:
-                url = url.rstrip('\n')
-                #print(url)
-                m = re.search(url, path_info)
-                m2 = re.search(re_comment_pattern, url)
-                if not m or not m2:
-                    continue
-                m_dict = m.groupdict()
-                m2_dict = m2.groupdict()
-                mac = m_dict.get('mac', '')
-                try:
-                    db = sqlite3.connect(SQLITE_DB)
-                    if VERSION_MAJOR == 2:
-                        db.text_factory = str
-                    s = db.execute('SELECT * FROM settings')
-                    settings = s.fetchone()
-                except IOError:
-                    db.close()
-                    return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
-                except sqlite3.OperationalError:
-                    db.close()
-                    return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
-
-
-                phone_server = settings[0]
-                mysql_host = settings[1]
-                mysql_user = settings[2]
-                mysql_pass = settings[3]
-                mysql_db = settings[4]
-                ntp_server = settings[6]
-                model_misc = settings[7]
-                try:
-                    model_misc = json.loads(model_misc)
-                except ValueError:
-                    model_misc = {}
-                context = {
-                        'environ': environ,
-                        'phone_server': phone_server,
-                        'ntp_server': ntp_server,
-                        'model_misc': model_misc,
-
-                        # Helper Functions
-                        'get_def_head': get_def_head,
-                        'get_menu': get_menu,
-                        #'handle_post': handle_custom_post,
-                }
-
-                if mac:
-                    #print(mac)
-                    try:
-                        c = db.execute('SELECT * FROM ext_mac_map WHERE mac=?', (mac,))
-                        r = c.fetchone()
-                        db.close()
-                    except IOError as e:
-                        db.close()
-                        print(e)
-                        return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
-                    except sqlite3.OperationalError as e:
-                        db.close()
-                        print(e)
-                        return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
-                    if not r:
-                        return
-                    ext = r[0]
-                    template = r[2]
-                    if r[3]:
-                        misc = json.loads(r[3])
-                    else:
-                        misc = {}
-                    if template != '{}/{}'.format(brand, model):
-                        continue
-                    template_misc = misc[template] if template in misc else {}
-                    context['ext'] = ext
-                    context['mac'] = mac
-                    context['template'] = template
-                    context['misc'] = template_misc
-                    try:
-                        ast_db = mysql.connect(host=mysql_host, user=mysql_user, passwd=mysql_pass, db=mysql_db)
-                        ast_c = ast_db.cursor()
-                        ast_c.execute("SELECT data FROM sip WHERE id=%s AND keyword='secret'", (ext,))
-                        secret_r = ast_c.fetchone()
-                        if not secret_r:
-                            return
-                        secret = secret_r[0]
-                        context['secret'] = secret
-                        ast_c.execute("SELECT name FROM users WHERE extension=%s", (ext,))
-                        name_r = ast_c.fetchone()
-                        name = name_r[0]
-                        context['name'] = name
-                        ast_db.close()
-                    except IOError as e:
-                        ast_db.close()
-                        print(e)
-                        return AppResponse('{}<div class="header">Problem connecting to the Freepbx Mysql DB.</div>'.format(get_def_head()), STATUS['ISE'])
-                    except mysql.InterfaceError as e:
-                        ast_dn.close()
-                        print(e)
-                        return AppResponse('{}<div class="header">Problem with MySQL/MariaDB database.</div>'.format(get_def_head()), STATUS['ISE'])
-                templatefile = m2_dict.get('templatefile', '')
-                fmt = m2_dict.get('format')
-                #print(templatefile)
-                #print(fmt)
-                template_path = os.path.join(brand, model, templatefile)
-                try:
-                    t = TEMPLATE_ENV.get_template(template_path).render(**context)
-                except TemplateNotFound as e:
-                    return AppResponse('{}<div class="header">Template File Missing!</div>{}'.format(get_def_head(), e), STATUS['Not Found'])
-                return AppResponse(t, STATUS['OK'], [ HEADER[fmt] if fmt in HEADER else HEADER['html'] ])
+    is_authed = session.get('is_authed')
+    if is_authed is not True:
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-def check_static_content(environ):
-    filename = environ.get('PATH_INFO', '').strip('/')
+    toast = ''
     try:
-        db = sqlite3.connect(SQLITE_DB)
-        if VERSION_MAJOR == 2:
-            db.text_factory = str
-        c = db.execute('SELECT static_folder FROM settings')
-        static_folder = c.fetchone()[0]
-        path = os.path.join(static_folder, filename)
-        if os.path.exists(path):
-            f = open(path, 'rb')
-            html_string = f.read()
-            f.close()
-        else:
-            return
+        db = connect_db()
+        if request_method == 'POST':
+            raw_post = environ.get('wsgi.input', '')
+            post_input = parse_qs(raw_post.readline().decode(), True)
+            typ = post_input.get('type', [''])[0]
+            name = post_input.get('name', [''])[0].strip()
+            if typ == 'add' and name:
+                fields = [post_input.get(f, [''])[0] for f in ('mysql_host', 'mysql_user', 'mysql_pass', 'mysql_db', 'ext_start', 'ext_end')]
+                db.execute('DELETE FROM backends WHERE name=?', (name, ))
+                db.execute('INSERT INTO backends VALUES (?, ?, ?, ?, ?, ?, ?)', [name] + fields)
+                record_change(db, [('backends', )])
+                db.commit()
+                toast = '<div class="message">Update Successful! {}</div>'.format(affected_message(db, [('backends', )]))
+            elif typ == 'del':
+                db.execute('DELETE FROM backends WHERE name=?', (name, ))
+                record_change(db, [('backends', )])
+                db.commit()
+        backends = get_backends(db)
         db.close()
     except IOError as e:
         db.close()
         print(e)
-        return
+        return AppResponse('{}<div class="header">Problem with database!</div>'.format(get_def_head()), STATUS['ISE'])
     except sqlite3.OperationalError as e:
         db.close()
         print(e)
-        return
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-    import mimetypes
-    m_type, _encoding = mimetypes.guess_type(filename)
-    if not m_type:
-        m_type = 'application/octet-stream'
+    backend_template = '''\
+<span class="ext_item">
+{label} - {mysql_user}@{mysql_host}/{mysql_db} - Extensions {ext_start}-{ext_end} - {status}
+{delete}</span>
+'''
+    delete_template = '''\
+<form onsubmit="if(confirm('Delete PBX {name}?')){{ajax_request('{base_url}/pbx-backends', serialize(this))}} return false;">
+<input type="hidden" name="type" value="del" />
+<input type="hidden" name="name" value="{name}" />
+<button class="delete">Delete</button>
+</form>
+'''
+    backends_html = []
+    for backend, count, error in map_backends(count_pbx_extensions, backends):
+        status = '{} users'.format(count) if error is None else 'Unreachable: {}'.format(error)
+        delete = delete_template.format(base_url=base_url, name=backend['name']) if backend['name'] else ''
+        backends_html.append(backend_template.format(label=backend['name'] or 'Default (Global Settings)',
+                                                     status=status, delete=delete, **backend))
 
-    return AppResponse(html_string, STATUS['OK'], [ ('Content-type', m_type) ])
+    string_format = {
+        'toast': toast,
+        'base_url': base_url,
+        'backends': '<br />'.join(backends_html),
+    }
+    html_string = '''\
+{toast}<form onsubmit="ajax_request('{base_url}/pbx-backends', serialize(this)); return false;">
+<input type="hidden" name="type" value="add" />
+<div class="inline-grid gr-two-col" style="text-align: right; gap: 0px 10px;">
+<label for="name">Name</label><input id="name" name="name" required />
+<label for="mysql_host">MySQL Host</label><input id="mysql_host" name="mysql_host" required />
+<label for="mysql_user">MySQL User</label><input id="mysql_user" name="mysql_user" required />
+<label for="mysql_pass">MySQL Pass</label><input id="mysql_pass" name="mysql_pass" required />
+<label for="mysql_db">MySQL DB</label><input id="mysql_db" name="mysql_db" value="asterisk" required />
+<label for="ext_start">First Extension</label><input id="ext_start" name="ext_start" />
+<label for="ext_end">Last Extension</label><input id="ext_end" name="ext_end" />
+</div><br />
+<button>Add/Update PBX</button>
+</form>
+<div class="header">PBX Backends</div>
 
-def hash_pw(pw):
-    salt = os.urandom(SALT_LEN)
-    key = pbkdf2_hmac('sha256', pw.encode('utf-8'), salt, 100000)
-    return salt + key
+{backends}
+'''.format(**string_format)
+    return AppResponse(html_string)
 
-def compare_hash(candidate, hashed_pw):
-    salt, key = hashed_pw[:SALT_LEN], hashed_pw[SALT_LEN:]
-    cand_key = pbkdf2_hmac('sha256', candidate.encode('utf-8'), salt, 100000)
-    return cand_key == key
-    
-def process_request(environ):
-    path_info = environ.get('PATH_INFO', '')
+def bulk_apply(db, phones, template='', misc=None):
+    """Sets the template and merges misc keys of phones in the open transaction
 
-    if path_info == '/' or path_info == '':
-        return get_index(environ)
+    misc keys are merged into each phone's settings for its template,
+    after the template is changed. The caller commits.
 
-    elif path_info == '/submit-setup':
-        return submit_setup(environ)
+    :param phones Phone dicts as returned by select_phones
+    :type phones list
+    :param template Template to assign, '' keeps each phone's own
+    :type template str
+    :param misc Model settings to merge, keyed like edit-phone form fields
+    :type misc dict
+    """
 
-    elif path_info == '/admin' or path_info == '/admin/':
-        return get_admin(environ)
+    rows = []
+    for phone in phones:
+        phone_template = template or phone['template']
+        phone_misc = phone['misc']
+        if misc:
+            phone_misc[phone_template] = dict(phone_misc.get(phone_template, {}), **misc)
+        rows.append((phone_template, json.dumps(phone_misc), phone['mac']))
+    db.executemany('UPDATE ext_mac_map SET template=?, misc=? WHERE mac=?', rows)
+    record_change(db, [('phone', phone['mac']) for phone in phones])
 
-    elif path_info == '/global-settings':
-        return get_global_settings(environ)
+def get_bulk_edit(environ):
+    request_method = environ.get('REQUEST_METHOD', '')
+    base_url = environ.get('SCRIPT_NAME', '')
+    session = environ['beaker.session']
+    is_authed = session.get('is_authed')
+    if is_authed is not True:
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-    elif path_info == '/model-globals':
-        return get_model_globals(environ)
+    toast = ''
+    post_input = {}
+    try:
+        db = connect_db()
+        if request_method == 'POST':
+            raw_post = environ.get('wsgi.input', '')
+            post_input = parse_qs(raw_post.readline().decode(), True)
+            filters = dict((f, post_input.get(f, [''])[0]) for f in ('template', 'ext_start', 'ext_end'))
+            macs = post_input.get('macs', [''])[0].split()
+            model = [m for m in post_input.get('model', []) if m != 'Choose a Model']
+            model = model[0] if model else ''
+            misc = {}
+            for line in post_input.get('misc', [''])[0].splitlines():
+                key, sep, value = line.partition('=')
+                if sep and key.strip():
+                    misc.setdefault(key.strip(), []).append(value.strip())
+            if not any(filters.values()) and not macs:
+                toast = '<div class="message">Choose phones by model, extension range or MAC!</div>'
+            else:
+                phones = select_phones(db, macs=macs, **filters)
+                if post_input.get('dry_run'):
+                    toast = '<div class="message">{} phones would change: {}</div>'.format(
+                        len(phones), ', '.join(p['extension'] for p in phones[:50]) + (' ...' if len(phones) > 50 else ''))
+                else:
+                    bulk_apply(db, phones, model, misc)
+                    db.commit()
+                    toast = '<div class="message">Updated {} phones!</div>'.format(len(phones))
+        db.close()
+    except IOError as e:
+        db.close()
+        print(e)
+        return AppResponse('{}<div class="header">Problem with database!</div>'.format(get_def_head()), STATUS['ISE'])
+    except sqlite3.OperationalError as e:
+        db.close()
+        print(e)
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-    elif path_info == '/phone-list':
-        return get_phone_list(environ)
+    string_format = dict(('{}_value'.format(f), post_input.get(f, [''])[0]) for f in ('template', 'ext_start', 'ext_end', 'macs', 'misc'))
+    string_format.update({
+        'toast': toast,
+        'base_url': base_url,
+        'template_select': get_template_select(),
+    })
+    html_string = '''\
+{toast}<div class="header">Bulk Edit</div>
+<form onsubmit="ajax_request('{base_url}/bulk-edit', serialize(this)); return false;">
+<div class="subheader">Phones</div>
+<div class="inline-grid gr-two-col" style="text-align: right; gap: 0px 10px;">
+<label for="template">Current Model (Brand/Model)</label><input id="template" name="template" value="{template_value}" />
+<label for="ext_start">First Extension</label><input id="ext_start" name="ext_start" value="{ext_start_value}" />
+<label for="ext_end">Last Extension</label><input id="ext_end" name="ext_end" value="{ext_end_value}" />
+<label for="macs">MACs</label><textarea id="macs" name="macs">{macs_value}</textarea>
+</div>
+<div class="subheader">Changes</div>
+New Model: {template_select}<br />
+<label for="misc">Model Settings (one key=value per line)</label><br />
+<textarea id="misc" name="misc">{misc_value}</textarea><br />
+<label for="dry_run">Dry Run</label><input type="checkbox" id="dry_run" name="dry_run" value="1" checked /><br />
+<button>Apply</button>
+</form>
+'''.format(**string_format)
+    return AppResponse(html_string)
 
-    elif path_info == '/edit-phone':
-        return edit_phone(environ)
+def get_jobs_page(environ):
+    request_method = environ.get('REQUEST_METHOD', '')
+    base_url = environ.get('SCRIPT_NAME', '')
+    session = environ['beaker.session']
+    is_authed = session.get('is_authed')
+    if is_authed is not True:
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-    elif path_info == '/account':
-        return get_account(environ)
+    toast = ''
+    try:
+        db = connect_db()
+        if request_method == 'POST':
+            raw_post = environ.get('wsgi.input', '')
+            post_input = parse_qs(raw_post.readline().decode(), True)
+            typ = post_input.get('type', [''])[0]
+            rowid = post_input.get('rowid', [''])[0]
+            if typ == 'import':
+                submit_job(db, 'import_phones', {'lines': post_input.get('lines', [''])[0].splitlines()})
+                toast = '<div class="message">Import Started!</div>'
+            elif typ == 'compile':
+                submit_job(db, 'compile_templates', {})
+                toast = '<div class="message">Template Check Started!</div>'
+            elif typ == 'cancel':
+                cancel_job(db, rowid)
+            elif typ == 'resume':
+                resume_job(db, rowid)
+            db.commit()
+        else:
+            start_job_runner()
+        jobs = get_jobs(db)
+        db.close()
+    except IOError as e:
+        db.close()
+        print(e)
+        return AppResponse('{}<div class="header">Problem with database!</div>'.format(get_def_head()), STATUS['ISE'])
+    except sqlite3.OperationalError as e:
+        db.close()
+        print(e)
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-    elif path_info == '/logout':
-        return get_logout(environ)
+    job_template = '''\
+<span class="ext_item">
+#{id} {kind} - {state} - {done}/{total} {message}
+{action}</span>
+'''
+    action_template = '''\
+<form onsubmit="ajax_request('{base_url}/jobs', serialize(this)); return false;">
+<input type="hidden" name="type" value="{typ}" />
+<input type="hidden" name="rowid" value="{rowid}" />
+<button class="{button_class}">{label}</button>
+</form>
+'''
+    jobs_html = []
+    for job in jobs:
+        action = ''
+        if job['state'] in ('queued', 'running'):
+            action = action_template.format(base_url=base_url, typ='cancel', rowid=job['id'], button_class='delete', label='Cancel')
+        elif job['state'] in ('failed', 'cancelled'):
+            action = action_template.format(base_url=base_url, typ='resume', rowid=job['id'], button_class='edit', label='Resume')
+        jobs_html.append(job_template.format(action=action, **dict(job, total=job['total'] or '?')))
+    poll = any(job['state'] in ('queued', 'running', 'cancelling') for job in jobs)
 
-    else:
-        cbu_ret = check_brand_urls(environ)
-        if cbu_ret:
-            return cbu_ret
+    string_format = {
+        'toast': toast,
+        'base_url': base_url,
+        'jobs': '<br />'.join(jobs_html),
+        'poll': '<div id="poll" data-url="{}/jobs"></div>'.format(base_url) if poll else '',
+    }
+    html_string = '''\
+{toast}{poll}<div class="header">Jobs</div>
+<form onsubmit="ajax_request('{base_url}/jobs', serialize(this)); return false;">
+<input type="hidden" name="type" value="import" />
+<label for="lines">Import Phones (one extension,mac[,brand/model] per line)</label><br />
+<textarea id="lines" name="lines" required></textarea><br />
+<button>Import</button>
+</form>
+<form onsubmit="ajax_request('{base_url}/jobs', serialize(this)); return false;">
+<input type="hidden" name="type" value="compile" />
+<button>Check Templates</button>
+</form>
 
-        csc_ret = check_static_content(environ)
-        if csc_ret:
-            return csc_ret
+{jobs}
+'''.format(**string_format)
+    return AppResponse(html_string)
 
-    return AppResponse('{}<h1>404 File Not Found!</h1>'.format(get_def_head()), STATUS['Not Found'])
+def get_resync(environ):
+    request_method = environ.get('REQUEST_METHOD', '')
+    base_url = environ.get('SCRIPT_NAME', '')
+    session = environ['beaker.session']
+    is_authed = session.get('is_authed')
+    if is_authed is not True:
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-def application(environ, start_response):
-    response = process_request(environ)
+    toast = ''
+    try:
+        db = connect_db()
+        if request_method == 'POST':
+            raw_post = environ.get('wsgi.input', '')
+            post_input = parse_qs(raw_post.readline().decode(), True)
+            typ = post_input.get('type', [''])[0]
+            if typ == 'ami':
+                backend = post_input.get('backend', [''])[0]
+                fields = [post_input.get(f, [''])[0] for f in ('host', 'port', 'username', 'secret', 'channel_driver')]
+                db.execute('DELETE FROM ami_settings WHERE backend=?', (backend, ))
+                db.execute('INSERT INTO ami_settings VALUES (?, ?, ?, ?, ?, ?)', [backend] + fields)
+                db.commit()
+                toast = '<div class="message">AMI Settings Saved!</div>'
+            elif typ == 'start':
+                changed_minutes = post_input.get('changed_minutes', [''])[0].strip()
+                try:
+                    changed_since = time.time() - float(changed_minutes) * 60 if changed_minutes else None
+                except ValueError:
+                    changed_since = False
+                if changed_since is False:
+                    toast = '<div class="message">Minutes must be a number!</div>'
+                else:
+                    params = {
+                        'filter': {
+                            'template': post_input.get('template', [''])[0],
+                            'ext_start': post_input.get('ext_start', [''])[0],
+                            'ext_end': post_input.get('ext_end', [''])[0],
+                            'macs': post_input.get('macs', [''])[0].split(),
+                            'changed_since': changed_since,
+                        },
+                        'dry_run': bool(post_input.get('dry_run')),
+                    }
+                    submit_job(db, 'resync', params)
+                    db.commit()
+                    toast = '<div class="message">Resync Started!</div>'
+        resync_jobs = get_jobs(db, 'resync', 1)
+        ami = get_ami_settings(db)
+        db.close()
+    except IOError as e:
+        db.close()
+        print(e)
+        return AppResponse('{}<div class="header">Problem with database!</div>'.format(get_def_head()), STATUS['ISE'])
+    except sqlite3.OperationalError as e:
+        db.close()
+        print(e)
+        return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
 
-    html = response.get_html()
-    if VERSION_MAJOR == 3 and isinstance(html, str):
-        html = bytes(html, 'utf-8')
+    if not resync_jobs:
+        status_html = 'No resync has run yet.'
+    else:
+        status_html = '{} {} <a onclick="ajax_request(\'{}/jobs\')">Jobs</a>'.format(
+            resync_jobs[0]['state'].capitalize(), resync_jobs[0]['message'], base_url)
 
-    if VERSION_MAJOR == 2 and isinstance(html, unicode):
-        html = str(html)
+    ami_template = '''\
+<form onsubmit="ajax_request('{base_url}/resync', serialize(this)); return false;">
+<input type="hidden" name="type" value="ami" />
+<input type="hidden" name="backend" value="{backend}" />
+{label}: <input name="host" value="{host}" placeholder="Host" />
+<input name="port" value="{port}" size="5" />
+<input name="username" value="{username}" placeholder="AMI User" />
+<input type="password" name="secret" value="{secret}" placeholder="AMI Secret" />
+<select name="channel_driver"><option value="pjsip"{pjsip}>PJSIP</option><option value="sip"{sip}>SIP</option></select>
+<button>Save</button>
+</form>
+'''
+    ami_html = ''.join([ami_template.format(base_url=base_url, backend=name, label=name or 'Default',
+                                            pjsip=' selected' if a['channel_driver'] == 'pjsip' else '',
+                                            sip=' selected' if a['channel_driver'] == 'sip' else '', **a)
+                        for name, a in sorted(ami.items())])
+    string_format = {
+        'toast': toast,
+        'base_url': base_url,
+        'status': status_html,
+        'ami': ami_html,
+    }
+    html_string = '''\
+{toast}<div class="header">Resync Phones</div>
+<div>{status}</div>
+<form onsubmit="ajax_request('{base_url}/resync', serialize(this)); return false;">
+<input type="hidden" name="type" value="start" />
+<div class="inline-grid gr-two-col" style="text-align: right; gap: 0px 10px;">
+<label for="template">Model (Brand/Model)</label><input id="template" name="template" />
+<label for="ext_start">First Extension</label><input id="ext_start" name="ext_start" />
+<label for="ext_end">Last Extension</label><input id="ext_end" name="ext_end" />
+<label for="macs">MACs</label><textarea id="macs" name="macs"></textarea>
+<label for="changed_minutes">Affected By Changes In The Last Minutes</label><input id="changed_minutes" name="changed_minutes" />
+<label for="dry_run">Dry Run</label><input type="checkbox" id="dry_run" name="dry_run" value="1" />
+</div><br />
+<button>Start Resync</button>
+</form>
+<div class="subheader">Asterisk Manager Interface</div>
+{ami}
+'''.format(**string_format)
+    return AppResponse(html_string)
 
-    start_response(response.get_status(), response.get_header())
+class APIError(Exception):
+    """Ends an API request with status and a JSON error message"""
 
-    return [html]
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def api_response(data, status=STATUS['OK'], etag=None):
+    header = [ HEADER['json'] ]
+    if etag is not None:
+        header.append(('ETag', etag))
+    return AppResponse(json.dumps(data), status, header)
+
+def make_etag(data):
+    return '"{}"'.format(hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest())
+
+def etag_matches(header, etag):
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in tags
+
+def check_if_match(environ, etag):
+    """Raises APIError unless the If-Match header, when given, names etag"""
+
+    if_match = environ.get('HTTP_IF_MATCH')
+    if if_match is not None and not etag_matches(if_match, etag):
+        raise APIError(STATUS['Precondition Failed'], 'The resource changed since it was read')
+
+def api_get(environ, data, etag=None):
+    """Returns data with its ETag, or 304 when the client already has it"""
+
+    if etag is None:
+        etag = make_etag(data)
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return AppResponse('', STATUS['Not Modified'], [ ('ETag', etag) ])
+    return api_response(data, etag=etag)
+
+def api_authed(environ):
+    """The admin session or HTTP Basic credentials of an admin user authorize API requests"""
+
+    session = environ.get('beaker.session')
+    if session is not None and session.get('is_authed') is True:
+        return True
+    authorization = environ.get('HTTP_AUTHORIZATION', '')
+    if not authorization.startswith('Basic '):
+        return False
+    try:
+        user, _sep, pwd = base64.b64decode(authorization[6:].strip()).decode('utf-8').partition(':')
+    except (ValueError, TypeError):
+        return False
+    db = connect_db()
+    try:
+        password = db.execute('SELECT password FROM users WHERE username=?', (user, )).fetchone()
+    finally:
+        db.close()
+    return password is not None and compare_hash(pwd, password[0])
+
+def read_json(environ):
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        return json.loads(environ['wsgi.input'].read(length).decode('utf-8'))
+    except (KeyError, ValueError):
+        raise APIError(STATUS['Bad Request'], 'Request body must be JSON')
+
+def project(data, fields):
+    if not fields:
+        return data
+    return dict((k, v) for k, v in data.items() if k in fields)
+
+def api_phone(row, extra_lines):
+    phone = phone_from_row(row)
+    phone['extra_lines'] = extra_lines
+    phone['etag'] = make_etag(phone)
+    return phone
+
+def get_api_phone(db, mac):
+    row = db.execute('SELECT * FROM ext_mac_map WHERE mac=?', (mac, )).fetchone()
+    if row is None:
+        raise APIError(STATUS['Not Found'], 'No phone with MAC {}'.format(mac))
+    return api_phone(row, get_phone_lines(db, [mac])[mac])
+
+def phone_values(item, phone=None):
+    """Validates an API phone object, filling in left out fields from phone"""
+
+    if not isinstance(item, dict):
+        raise APIError(STATUS['Bad Request'], 'Phones must be JSON objects')
+    values = dict(phone or {'extension': '', 'mac': '', 'template': '', 'misc': {}, 'backend': '', 'extra_lines': []})
+    values.update((k, item[k]) for k in EXT_MAC_MAP_COLUMNS + ('extra_lines', ) if k in item)
+    values['mac'] = str(values['mac']).replace(':', '').lower()
+    values['extension'] = str(values['extension'])
+    if not values['mac'] or not values['extension']:
+        raise APIError(STATUS['Bad Request'], 'Phones need an extension and a mac')
+    if not isinstance(values['misc'], dict):
+        raise APIError(STATUS['Bad Request'], 'misc must be a JSON object')
+    if not isinstance(values['extra_lines'], list):
+        raise APIError(STATUS['Bad Request'], 'extra_lines must be a list of extensions')
+    values['extra_lines'] = [str(ext) for ext in values['extra_lines']]
+    return values
+
+def write_phones(db, create=(), update=(), delete=()):
+    """Applies a batch of phone changes in the open transaction
+
+    Updates and deletes may carry the etag they were read with, and fail
+    with 412 when the phone changed since. The caller commits or rolls back.
+
+    :return (changed phones, MACs whose provisioning files changed)
+    :rtype tuple
+    """
+
+    changed = []
+    macs = set()
+    for item in delete:
+        mac = item.get('mac', '') if isinstance(item, dict) else item
+        phone = get_api_phone(db, str(mac).replace(':', '').lower())
+        if isinstance(item, dict) and item.get('etag') not in (None, phone['etag']):
+            raise APIError(STATUS['Precondition Failed'], 'Phone {} changed since it was read'.format(phone['mac']))
+        db.execute('DELETE FROM ext_mac_map WHERE mac=?', (phone['mac'], ))
+        db.execute('DELETE FROM phone_lines WHERE mac=?', (phone['mac'], ))
+        macs.add(phone['mac'])
+    for item in update:
+        if not isinstance(item, dict):
+            raise APIError(STATUS['Bad Request'], 'Phones must be JSON objects')
+        phone = get_api_phone(db, str(item.get('match_mac', item.get('mac', ''))).replace(':', '').lower())
+        if item.get('etag') not in (None, phone['etag']):
+            raise APIError(STATUS['Precondition Failed'], 'Phone {} changed since it was read'.format(phone['mac']))
+        phone.pop('etag')
+        values = phone_values(item, phone)
+        if values['mac'] != phone['mac'] and db.execute('SELECT 1 FROM ext_mac_map WHERE mac=?', (values['mac'], )).fetchone():
+            raise APIError(STATUS['Conflict'], 'A phone with MAC {} already exists'.format(values['mac']))
+        db.execute('UPDATE ext_mac_map SET extension=?, mac=?, template=?, misc=?, backend=? WHERE mac=?',
+                   (values['extension'], values['mac'], values['template'], json.dumps(values['misc']), values['backend'], phone['mac']))
+        set_phone_lines(db, values['mac'], values['extra_lines'], phone['mac'])
+        macs.update((phone['mac'], values['mac']))
+        changed.append(values['mac'])
+    for item in create:
+        values = phone_values(item)
+        if db.execute('SELECT 1 FROM ext_mac_map WHERE mac=?', (values['mac'], )).fetchone():
+            raise APIError(STATUS['Conflict'], 'A phone with MAC {} already exists'.format(values['mac']))
+        db.execute('INSERT INTO ext_mac_map (extension, mac, template, misc, backend) VALUES (?, ?, ?, ?, ?)',
+                   (values['extension'], values['mac'], values['template'], json.dumps(values['misc']), values['backend']))
+        set_phone_lines(db, values['mac'], values['extra_lines'])
+        macs.add(values['mac'])
+        changed.append(values['mac'])
+    record_change(db, [('phone', mac) for mac in sorted(macs)])
+    return [get_api_phone(db, mac) for mac in changed], macs
+
+def api_phones(environ, db, mac):
+    request_method = environ.get('REQUEST_METHOD', '')
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    fields = [f for f in query.get('fields', [''])[0].split(',') if f]
+    if mac and request_method == 'GET':
+        phone = get_api_phone(db, mac)
+        return api_get(environ, project(phone, fields), phone['etag'])
+    elif mac and request_method in ('PUT', 'PATCH', 'DELETE'):
+        check_if_match(environ, get_api_phone(db, mac)['etag'])
+        if request_method == 'DELETE':
+            write_phones(db, delete=[mac])
+            phones = []
+        else:
+            item = read_json(environ)
+            if not isinstance(item, dict):
+                raise APIError(STATUS['Bad Request'], 'Phones must be JSON objects')
+            item = dict(item, match_mac=mac)
+            item.pop('etag', None)
+            phones, _macs = write_phones(db, update=[item])
+    elif not mac and request_method == 'GET':
+        try:
+            limit = max(1, min(int(query.get('limit', [API_PAGE_SIZE])[0]), API_MAX_PAGE_SIZE))
+            cursor = int(query.get('cursor', ['0'])[0] or 0)
+        except ValueError:
+            raise APIError(STATUS['Bad Request'], 'limit and cursor must be numbers')
+        sql = 'SELECT rowid,* FROM ext_mac_map WHERE rowid > ?'
+        args = [cursor]
+        for column in ('extension', 'template', 'backend'):
+            if column in query:
+                sql += ' AND {}=?'.format(column)
+                args.append(query[column][0])
+        rows = db.execute(sql + ' ORDER BY rowid LIMIT ?', args + [limit + 1]).fetchall()
+        lines = get_phone_lines(db, [r[2] for r in rows[:limit]])
+        data = {
+            'phones': [project(api_phone(r[1:], lines[r[2]]), fields) for r in rows[:limit]],
+            'next_cursor': str(rows[limit - 1][0]) if len(rows) > limit else None,
+        }
+        return api_get(environ, data)
+    elif not mac and request_method == 'POST':
+        batch = read_json(environ)
+        if not isinstance(batch, dict):
+            raise APIError(STATUS['Bad Request'], 'Expected an object with create, update and delete lists')
+        phones, _macs = write_phones(db, batch.get('create', []), batch.get('update', []), batch.get('delete', []))
+    else:
+        raise APIError(STATUS['Method Not Allowed'], 'Method not allowed')
+
+    db.commit()
+    for phone in phones:
+        UNKNOWN_MACS.discard((LOCAL_SOURCE.version, phone['mac']))
+    return api_response({'phones': [project(p, fields) for p in phones]})
+
+def api_bulk_apply(environ, db):
+    """Sets template and/or merges misc keys for every phone matching filter
+
+    Nothing is written when dry_run is true, only the matching phones are returned.
+    """
+
+    if environ.get('REQUEST_METHOD', '') != 'POST':
+        raise APIError(STATUS['Method Not Allowed'], 'Method not allowed')
+    body = read_json(environ)
+    if not isinstance(body, dict) or not isinstance(body.get('filter'), dict):
+        raise APIError(STATUS['Bad Request'], 'Expected an object with a filter object')
+    filters = dict((k, str(body['filter'].get(k) or '')) for k in ('template', 'ext_start', 'ext_end'))
+    macs = body['filter'].get('macs') or []
+    if not any(filters.values()) and not macs:
+        raise APIError(STATUS['Bad Request'], 'Filter by template, extension range or macs')
+    if not isinstance(body.get('misc') or {}, dict):
+        raise APIError(STATUS['Bad Request'], 'misc must be a JSON object')
+    phones = select_phones(db, macs=macs, **filters)
+    if not body.get('dry_run'):
+        bulk_apply(db, phones, body.get('template') or '', body.get('misc'))
+        db.commit()
+    return api_response({'count': len(phones), 'macs': [p['mac'] for p in phones], 'dry_run': bool(body.get('dry_run'))})
+
+def api_jobs(environ, db, key):
+    """Lists, submits, cancels and resumes background jobs"""
+
+    request_method = environ.get('REQUEST_METHOD', '')
+    rowid, _sep, action = key.partition('/')
+    if not rowid and request_method == 'GET':
+        return api_get(environ, {'jobs': get_jobs(db)})
+    elif not rowid and request_method == 'POST':
+        body = read_json(environ)
+        if not isinstance(body, dict) or body.get('kind') not in JOB_HANDLERS:
+            raise APIError(STATUS['Bad Request'], 'kind must be one of {}'.format(', '.join(sorted(JOB_HANDLERS))))
+        params = body.get('params') or {}
+        if body['kind'] == 'resync':
+            error = resync_params_error(params)
+            if error:
+                raise APIError(STATUS['Bad Request'], error)
+        rowid = submit_job(db, body['kind'], params)
+        db.commit()
+    elif rowid and request_method == 'DELETE':
+        cancel_job(db, rowid)
+        db.commit()
+    elif rowid and action == 'resume' and request_method == 'POST':
+        resume_job(db, rowid)
+        db.commit()
+    elif not rowid or request_method != 'GET' or action:
+        raise APIError(STATUS['Method Not Allowed'], 'Method not allowed')
+    row = db.execute('SELECT rowid,* FROM jobs WHERE rowid=?', (rowid, )).fetchone()
+    if row is None:
+        raise APIError(STATUS['Not Found'], 'No job {}'.format(rowid))
+    return api_get(environ, job_from_row(row))
+
+def public_settings(settings):
+    """Returns the settings without mysql_pass, which the API accepts but never sends"""
+
+    return dict((k, v) for k, v in settings.items() if k != 'mysql_pass')
+
+def api_settings(environ, db):
+    request_method = environ.get('REQUEST_METHOD', '')
+    settings = dict(zip(SETTINGS_COLUMNS[:-1], db.execute('SELECT * FROM settings').fetchone()))
+    if request_method == 'GET':
+        return api_get(environ, public_settings(settings))
+    elif request_method not in ('PUT', 'PATCH'):
+        raise APIError(STATUS['Method Not Allowed'], 'Method not allowed')
+    check_if_match(environ, make_etag(public_settings(settings)))
+    values = read_json(environ)
+    if not isinstance(values, dict):
+        raise APIError(STATUS['Bad Request'], 'Settings must be a JSON object')
+    settings.update((k, str(values[k])) for k in SETTINGS_COLUMNS[:-1] if k in values)
+    update_settings(db, settings)
+    db.commit()
+    settings = public_settings(settings)
+    return api_response(settings, etag=make_etag(settings))
+
+def api_model_globals(environ, db, model):
+    request_method = environ.get('REQUEST_METHOD', '')
+    try:
+        model_misc = json.loads(db.execute('SELECT model_misc FROM settings').fetchone()[0])
+    except (TypeError, ValueError):
+        model_misc = {}
+    if not model and request_method == 'GET':
+        return api_get(environ, model_misc)
+    elif model and request_method == 'GET':
+        return api_get(environ, model_misc.get(model, {}))
+    elif not model or request_method not in ('PUT', 'PATCH'):
+        raise APIError(STATUS['Method Not Allowed'], 'Method not allowed')
+    check_if_match(environ, make_etag(model_misc.get(model, {})))
+    values = read_json(environ)
+    if not isinstance(values, dict):
+        raise APIError(STATUS['Bad Request'], 'Model globals must be a JSON object')
+    model_misc[model] = values if request_method == 'PUT' else dict(model_misc.get(model, {}), **values)
+    db.execute('UPDATE settings SET model_misc=? WHERE rowid=1', (json.dumps(model_misc), ))
+    record_change(db, [('model_misc', model)])
+    db.commit()
+    return api_response(model_misc[model], etag=make_etag(model_misc[model]))
+
+def api_request(environ):
+    """JSON API for phones, model globals and settings under /api/v1
+
+    Answers with a JSON error object and a matching status when a request fails.
+    Writes happen in one transaction, so a failing batch changes nothing.
+    """
+
+    path = environ.get('PATH_INFO', '')[len('/api/v1/'):].strip('/')
+    resource, _sep, key = path.partition('/')
+    try:
+        if not api_authed(environ):
+            return AppResponse(json.dumps({'error': 'Authentication required'}), STATUS['Unauthorized'],
+                               [ HEADER['json'], ('WWW-Authenticate', 'Basic realm="{}"'.format(APP_TITLE)) ])
+    except sqlite3.OperationalError as e:
+        print(e)
+        return api_response({'error': 'Database Error'}, STATUS['ISE'])
+    try:
+        db = connect_db()
+    except IOError as e:
+        print(e)
+        return api_response({'error': 'Problem accessing the database'}, STATUS['ISE'])
+    try:
+        if resource == 'phones' and key == 'bulk':
+            return api_bulk_apply(environ, db)
+        elif resource == 'phones':
+            return api_phones(environ, db, key.replace(':', '').lower())
+        elif resource == 'jobs':
+            return api_jobs(environ, db, key)
+        elif resource == 'settings' and not key:
+            return api_settings(environ, db)
+        elif resource == 'model-globals':
+            return api_model_globals(environ, db, key)
+        raise APIError(STATUS['Not Found'], 'No such resource')
+    except APIError as e:
+        db.rollback()
+        return api_response({'error': str(e)}, e.status)
+    except sqlite3.OperationalError as e:
+        db.rollback()
+        print(e)
+        return api_response({'error': 'Database Error'}, STATUS['ISE'])
+    finally:
+        db.close()
+
+def get_logout(environ):
+    base_url = environ.get('SCRIPT_NAME', '')
+    session = environ['beaker.session']
+    session['is_authed'] = None
+    session['user'] = None
+    session.save()
+    return AppResponse('', STATUS['Redirect'], [ ('Location', base_url) ])
+
+def connect_db():
+    """Opens the sqlite database, upgrading its schema once per process
+
+    :return sqlite3 connection
+    :rtype sqlite3.Connection
+    """
+
+    db = sqlite3.connect(SQLITE_DB)
+    if VERSION_MAJOR == 2:
+        db.text_factory = str
+    upgrade_db(db)
+    return db
+
+_DB_UPGRADED = []
+
+def upgrade_db(db):
+    """Adds tables and columns introduced after the initial setup
+
+    Does nothing until the setup page has created the settings table.
+    """
+
+    if _DB_UPGRADED:
+        return
+    try:
+        db.execute('SELECT * FROM settings LIMIT 1')
+    except sqlite3.OperationalError:
+        return
+    with open(os.path.join(os.path.dirname(__file__), 'db.sql')) as sql_file:
+        script = sql_file.read()
+    db.executescript(script)
+    columns = [r[1] for r in db.execute('PRAGMA table_info(ext_mac_map)')]
+    for column in EXT_MAC_MAP_COLUMNS:
+        if column not in columns:
+            db.execute('ALTER TABLE ext_mac_map ADD COLUMN {} TEXT'.format(column))
+    if 'runner' not in [r[1] for r in db.execute('PRAGMA table_info(jobs)')]:
+        db.execute('ALTER TABLE jobs ADD COLUMN runner TEXT')
+    db.commit()
+    _DB_UPGRADED.append(True)
+
+class CircuitOpen(IOError):
+    """Raised instead of connecting while a PBX backend's circuit breaker is open"""
+
+class CircuitBreaker(object):
+    """Stops calls to a failing service for a while, then lets single probes through
+
+    After BREAKER_FAILURES consecutive failures the breaker opens for
+    BREAKER_COOLDOWN seconds. After that one call at a time is let through
+    as a probe. A successful probe closes the breaker and a failed one
+    opens it again.
+    """
+
+    def __init__(self, max_failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.probing or time.time() - self.opened < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened is not None or self.failures >= self.max_failures:
+                self.opened = time.time()
+
+    def released(self):
+        """Ends a call that said nothing about the service, so the next call may probe"""
+
+        with self.lock:
+            self.probing = False
+
+    def state(self):
+        with self.lock:
+            if self.opened is None:
+                return 'closed'
+            if self.probing or time.time() - self.opened >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+class MySQLPool(object):
+    """Small thread safe pool of connections to one FreePBX MySQL database"""
+
+    def __init__(self, host, user, passwd, db, size=MYSQL_POOL_SIZE):
+        self.key = (host, user, passwd, db)
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+
+    def get(self):
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                conn, returned = self.idle.pop()
+                if now - returned < MYSQL_POOL_IDLE:
+                    return conn
+                self.discard(conn)
+        host, user, passwd, db = self.key
+        return mysql.connect(host=host, user=user, passwd=passwd, db=db, connect_timeout=MYSQL_CONNECT_TIMEOUT)
+
+    def put(self, conn):
+        try:
+            conn.rollback()
+        except mysql_errors():
+            self.discard(conn)
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except mysql_errors():
+            pass
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _returned in idle:
+            self.discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection, dropping it instead of returning it on errors
+
+        Connection and query failures count against the pool's circuit
+        breaker. While it is open, CircuitOpen is raised without connecting.
+        """
+
+        if not self.breaker.allow():
+            raise CircuitOpen('FreePBX database on {} is unavailable, retrying in up to {} seconds'.format(
+                self.key[0], BREAKER_COOLDOWN))
+        try:
+            conn = self.get()
+        except Exception:
+            self.breaker.failed()
+            raise
+        try:
+            yield conn
+        except IOError:
+            self.discard(conn)
+            self.breaker.failed()
+            raise
+        except mysql_errors():
+            self.discard(conn)
+            self.breaker.failed()
+            raise
+        except Exception:
+            # Not a database error, so neither a success nor a failure
+            self.discard(conn)
+            self.breaker.released()
+            raise
+        self.breaker.succeeded()
+        self.put(conn)
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_CREDENTIAL_CACHE = {}
+_CREDENTIAL_LOCK = threading.Lock()
+
+def backend_from_row(row):
+    return dict(zip(('name', 'mysql_host', 'mysql_user', 'mysql_pass', 'mysql_db', 'ext_start', 'ext_end'), row))
+
+def get_backends(db):
+    """Returns every PBX backend, starting with the default one from settings
+
+    :param db Open sqlite connection
+    :type db sqlite3.Connection
+    :return List of backend dicts
+    :rtype list
+    """
+
+    c = db.execute('SELECT mysql_host, mysql_user, mysql_pass, mysql_db FROM settings')
+    settings = c.fetchone()
+    backends = [backend_from_row(('', ) + tuple(settings) + ('', ''))]
+    c = db.execute('SELECT name, mysql_host, mysql_user, mysql_pass, mysql_db, ext_start, ext_end FROM backends ORDER BY name')
+    backends.extend([backend_from_row(r) for r in c.fetchall()])
+    return backends
+
+def ext_in_range(ext, start, end):
+    if not start and not end:
+        return False
+    ext = ext or ''
+    start = start or None
+    end = end or None
+    if ext.isdigit() and all(v.isdigit() for v in (start, end) if v):
+        ext = int(ext)
+        start = int(start) if start else None
+        end = int(end) if end else None
+    return (start is None or start <= ext) and (end is None or ext <= end)
+
+def resolve_backend(backends, ext, name=''):
+    """Picks the backend a phone is provisioned from
+
+    An explicit per-phone assignment wins, then the first backend whose
+    extension range holds ext, then the default backend from settings.
+    """
+
+    if name:
+        for backend in backends:
+            if backend['name'] == name:
+                return backend
+    for backend in backends[1:]:
+        if ext_in_range(ext, backend['ext_start'], backend['ext_end']):
+            return backend
+    return backends[0]
+
+def get_pool(backend):
+    key = (backend['mysql_host'], backend['mysql_user'], backend['mysql_pass'], backend['mysql_db'])
+    with _POOLS_LOCK:
+        pool = _POOLS.get(backend['name'])
+        if pool is not None and pool.key == key:
+            return pool
+        if pool is not None:
+            pool.close_all()
+        pool = _POOLS[backend['name']] = MySQLPool(*key)
+        return pool
+
+def get_pbx_user(backend, ext):
+    """Looks up the sip secret and user name of ext on a backend
+
+    :return Tuple of (secret, name) or None if the extension has no secret
+    :rtype tuple
+    """
+
+    return get_pbx_users(backend, [ext])[ext]
+
+def get_pbx_users(backend, exts, stale=None):
+    """Looks up the sip secrets and user names of several extensions on a backend
+
+    Extensions missing from the credential cache are fetched with one
+    batched IN (...) query, and every result is cached for
+    CREDENTIAL_CACHE_TTL seconds.
+
+    :param stale When given, a set that receives the extensions answered
+        from expired cache entries because the backend could not be read.
+        Without it, backend errors are raised.
+    :type stale set
+    :return Dict of extension to (secret, name), or None for extensions without a secret
+    :rtype dict
+    """
+
+    now = time.time()
+    users = {}
+    missing = []
+    with _CREDENTIAL_LOCK:
+        for ext in exts:
+            cached = _CREDENTIAL_CACHE.get((backend['name'], backend['mysql_host'], backend['mysql_db'], ext))
+            if cached and cached[0] > now:
+                users[ext] = cached[1]
+            else:
+                missing.append(ext)
+    if not missing:
+        return users
+
+    found = {}
+    try:
+        with get_pool(backend).connection() as ast_db:
+            ast_c = ast_db.cursor()
+            for i in range(0, len(missing), PBX_BATCH_SIZE):
+                batch = missing[i:i + PBX_BATCH_SIZE]
+                ast_c.execute("""SELECT sip.id, sip.data, users.name FROM sip LEFT JOIN users ON users.extension=sip.id
+                                 WHERE sip.keyword='secret' AND sip.id IN ({})""".format(', '.join(['%s'] * len(batch))), tuple(batch))
+                found.update((str(r[0]), (r[1], r[2] or '')) for r in ast_c.fetchall())
+            ast_c.close()
+    except IOError:
+        if not stale_pbx_users(backend, missing, users, stale):
+            raise
+        return users
+    except mysql_errors():
+        if not stale_pbx_users(backend, missing, users, stale):
+            raise
+        return users
+
+    with _CREDENTIAL_LOCK:
+        for ext in missing:
+            users[ext] = found.get(ext)
+            _CREDENTIAL_CACHE[(backend['name'], backend['mysql_host'], backend['mysql_db'], ext)] = (now + CREDENTIAL_CACHE_TTL, users[ext])
+    return users
+
+def stale_pbx_users(backend, exts, users, stale):
+    """Fills users with the expired cache entries of exts, adding them to stale
+
+    :return Whether every extension had an entry to fall back on
+    :rtype bool
+    """
+
+    if stale is None:
+        return False
+    with _CREDENTIAL_LOCK:
+        cached = [(ext, _CREDENTIAL_CACHE.get((backend['name'], backend['mysql_host'], backend['mysql_db'], ext))) for ext in exts]
+    if any(entry is None for _ext, entry in cached):
+        return False
+    for ext, entry in cached:
+        users[ext] = entry[1]
+        stale.add(ext)
+    return True
+
+def map_backends(func, backends):
+    """Calls func(backend) for every backend in parallel threads
+
+    :return List of (backend, result, exception) tuples in backend order
+    :rtype list
+    """
+
+    results = [None] * len(backends)
+
+    def run(i, backend):
+        try:
+            results[i] = (backend, func(backend), None)
+        except Exception as e:
+            results[i] = (backend, None, e)
+
+    threads = [threading.Thread(target=run, args=(i, b)) for i, b in enumerate(backends)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def count_pbx_extensions(backend):
+    with get_pool(backend).connection() as ast_db:
+        ast_c = ast_db.cursor()
+        ast_c.execute('SELECT COUNT(*) FROM users')
+        count = ast_c.fetchone()[0]
+        ast_c.close()
+    return count
+
+class LocalSource(object):
+    """Provisioning data read live from prov.db, FreePBX MySQL and the templates folder"""
+
+    version = None
+
+    def __init__(self, templates_folder=TEMPLATES_FOLDER, template_env=TEMPLATE_ENV):
+        self.templates_folder = templates_folder
+        self.template_env = template_env
+        self.routes = None
+        self.routes_loaded = 0
+        self.template_mtimes = None
+
+    def model_urls(self):
+        """Returns (brand, model, urls lines) for every model with a urls file
+
+        The templates folder is rescanned at most every ROUTE_CACHE_TTL seconds,
+        which is also when outputs of changed template files are invalidated.
+        """
+
+        routes = self.routes
+        now = time.time()
+        if routes is None or now - self.routes_loaded > ROUTE_CACHE_TTL:
+            self.routes_loaded = now
+            check_template_changes(self)
+            routes = self.routes = list(self.scan_model_urls())
+        return routes
+
+    def scan_model_urls(self):
+        try:
+            walk_g = os.walk(self.templates_folder)
+            brands = next(walk_g)[1]
+        except StopIteration:
+            return
+
+        for brand in brands:
+            brand_walk_g = os.walk(os.path.join(self.templates_folder, brand))
+            models = next(brand_walk_g)[1]
+            for model in models:
+                fn = os.path.join(self.templates_folder, brand, model, 'urls')
+                try:
+                    with open(fn, 'r') as urls_file:
+                        urls = urls_file.readlines()
+                except FileNotFoundError:
+                    continue
+                yield brand, model, [url.rstrip('\n') for url in urls]
+
+    def lookup(self, mac=''):
+        """Returns the settings dict and, when mac is given, the phone dict or None"""
+
+        db = connect_db()
+        try:
+            s = db.execute('SELECT * FROM settings')
+            settings = dict(zip(SETTINGS_COLUMNS, s.fetchone()))
+            phone = None
+            if mac:
+                c = db.execute('SELECT * FROM ext_mac_map WHERE mac=?', (mac,))
+                r = c.fetchone()
+                if r:
+                    phone = phone_from_row(r)
+                    phone['backend'] = resolve_backend(get_backends(db), phone['extension'], phone['backend'])
+                    phone['lines'] = [phone['extension']] + get_phone_lines(db, [mac])[mac]
+        finally:
+            db.close()
+        return settings, phone
+
+    def get_pbx_users(self, phone, stale=None):
+        return get_pbx_users(phone['backend'], phone['lines'], stale)
+
+    def get_directory(self):
+        return get_directory()
+
+def phone_from_row(row):
+    phone = dict(zip(EXT_MAC_MAP_COLUMNS, row))
+    try:
+        phone['misc'] = json.loads(phone['misc']) if phone['misc'] else {}
+    except ValueError:
+        phone['misc'] = {}
+    phone['backend'] = phone['backend'] or ''
+    return phone
+
+def get_phone_lines(db, macs):
+    """Returns the extensions of the extra lines of each MAC, in line order
+
+    Line 1 is the phone's own extension in ext_mac_map and is not included.
+
+    :rtype dict
+    """
+
+    lines = dict((mac, []) for mac in macs)
+    for i in range(0, len(macs), PBX_BATCH_SIZE):
+        batch = list(macs[i:i + PBX_BATCH_SIZE])
+        c = db.execute('SELECT mac, extension FROM phone_lines WHERE mac IN ({}) ORDER BY mac, line'.format(
+            ', '.join(['?'] * len(batch))), batch)
+        for mac, ext in c.fetchall():
+            lines[mac].append(ext)
+    return lines
+
+def set_phone_lines(db, mac, extensions, old_mac=None):
+    """Replaces the extra lines of a phone in the open transaction, moving them when its MAC changed"""
+
+    db.execute('DELETE FROM phone_lines WHERE mac=?', (old_mac or mac, ))
+    db.executemany('INSERT INTO phone_lines VALUES (?, ?, ?)', [(mac, n, ext) for n, ext in enumerate(extensions, 2)])
+
+LOCAL_SOURCE = LocalSource()
+
+_DIRECTORY = {'snapshot': None}
+_DIRECTORY_LOCK = threading.Lock()
+
+def fetch_pbx_directory(backend):
+    with get_pool(backend).connection() as ast_db:
+        ast_c = ast_db.cursor()
+        ast_c.execute('SELECT extension, name FROM users')
+        rows = ast_c.fetchall()
+        ast_c.close()
+    return [{'extension': str(ext), 'name': name, 'backend': backend['name']} for ext, name in rows]
+
+def extension_sort_key(entry):
+    ext = entry['extension']
+    return (0, int(ext), '') if ext.isdigit() else (1, 0, ext)
+
+def get_directory():
+    """Returns the directory snapshot of every extension on every PBX backend
+
+    The snapshot is a dict with 'version', a checksum of its entries, and
+    'entries', a list of extension/name/backend dicts sorted by extension.
+    It is refreshed in bulk every DIRECTORY_REFRESH seconds, keeping the
+    previous entries of any backend that cannot be reached. A backend that
+    has never been read is tried again on the next call instead. While one
+    thread refreshes, the others keep using the old snapshot.
+    """
+
+    snapshot = _DIRECTORY['snapshot']
+    if snapshot is not None and time.time() - snapshot['loaded'] < DIRECTORY_REFRESH:
+        return snapshot
+    if not _DIRECTORY_LOCK.acquire(False):
+        if snapshot is not None:
+            return snapshot
+        _DIRECTORY_LOCK.acquire()
+    try:
+        if _DIRECTORY['snapshot'] is not snapshot:
+            return _DIRECTORY['snapshot']
+        db = connect_db()
+        try:
+            backends = get_backends(db)
+        finally:
+            db.close()
+        by_backend = {}
+        loaded = time.time()
+        for backend, entries, error in map_backends(fetch_pbx_directory, backends):
+            if error is not None:
+                print(error)
+                if snapshot is None or backend['name'] not in snapshot['by_backend']:
+                    loaded = 0
+                    continue
+                entries = snapshot['by_backend'][backend['name']]
+            by_backend[backend['name']] = entries
+        entries = sorted([e for name in by_backend for e in by_backend[name]], key=extension_sort_key)
+        version = hashlib.sha1(json.dumps(entries, sort_keys=True).encode('utf-8')).hexdigest()
+        if snapshot is not None and snapshot['version'] != version:
+            # Every process refreshes its own snapshot, so nothing goes to change_log
+            invalidate_outputs([('directory', )])
+        snapshot = {'version': version, 'entries': entries, 'by_backend': by_backend, 'loaded': loaded}
+        _DIRECTORY['snapshot'] = snapshot
+        return snapshot
+    finally:
+        _DIRECTORY_LOCK.release()
+
+def load_model_misc(settings):
+    try:
+        return json.loads(settings['model_misc'])
+    except (TypeError, ValueError):
+        return {}
+
+def phonebook_context(environ, settings, directory, brand, model):
+    """Builds the variables a phonebook.template is rendered with"""
+
+    model_misc = load_model_misc(settings)
+    return {
+            'environ': environ,
+            'phone_server': settings['phone_server'],
+            'model_misc': model_misc,
+            'misc': model_misc.get('{}/{}'.format(brand, model), {}),
+            'directory': directory['entries'],
+    }
+
+def render_phonebook(environ, brand, model, fmt, source=None):
+    """Renders a model's phonebook.template with the whole directory
+
+    The output is streamed and then kept in RENDER_CACHE until the directory
+    snapshot, the settings it uses or the template files change. Requests
+    arriving while it renders wait for that output instead of rendering too.
+    """
+
+    if source is None:
+        source = get_provisioning_source()
+    try:
+        with server_timing(environ, 'lookup'):
+            settings, _phone = source.lookup()
+        with server_timing(environ, 'backend'):
+            directory = source.get_directory()
+    except IOError as e:
+        print(e)
+        return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
+    except sqlite3.OperationalError as e:
+        print(e)
+        return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
+
+    template_path = os.path.join(brand, model, PHONEBOOK_TEMPLATE)
+    try:
+        template = source.template_env.get_template(template_path)
+    except TemplateNotFound as e:
+        return AppResponse('{}<div class="header">Template File Missing!</div>{}'.format(get_def_head(), e), STATUS['Not Found'])
+    header = [ HEADER[fmt] if fmt in HEADER else HEADER['xml'] ]
+
+    cache_key = (source.version, 'phonebook', template_path)
+    cached = RENDER_CACHE.get(cache_key)
+    if cached is not None:
+        return AppResponse(cached, STATUS['OK'], header)
+
+    deps, cacheable = output_dependencies(source.template_env, template_path)
+    if cacheable:
+        leader, call = RENDER_FLIGHTS.join(cache_key)
+        if not leader and call['result'] is not None:
+            return AppResponse(call['result'], STATUS['OK'], header)
+    context = phonebook_context(environ, settings, directory, brand, model)
+    if not cacheable or not leader:
+        with server_timing(environ, 'render'):
+            return AppResponse(start_stream(template.generate(**context)), STATUS['OK'], header)
+    deps.update([('directory', ), ('model_misc', '{}/{}'.format(brand, model))])
+
+    def record(chunks):
+        output = []
+        body = None
+        try:
+            for chunk in chunks:
+                output.append(chunk)
+                yield chunk
+            body = u''.join(output)
+            RENDER_CACHE.put(cache_key, body, deps, min(RENDER_CACHE_TTL, DIRECTORY_REFRESH))
+        finally:
+            RENDER_FLIGHTS.finish(cache_key, call, body)
+
+    with server_timing(environ, 'render'):
+        return AppResponse(start_stream(record(template.generate(**context))), STATUS['OK'], header)
+
+class ExpiringSet(object):
+    """Thread safe set whose members expire after ttl seconds
+
+    Holds at most size members, dropping the oldest first.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.members = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            added = self.members.get(key)
+            if added is None:
+                return False
+            if time.time() - added < self.ttl:
+                return True
+            del self.members[key]
+            return False
+
+    def add(self, key):
+        with self.lock:
+            self.members.pop(key, None)
+            self.members[key] = time.time()
+            while len(self.members) > self.size:
+                self.members.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.members.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.members.clear()
+
+class TokenBuckets(object):
+    """Thread safe token bucket per client, refilled at rate tokens per second up to burst
+
+    Only the size most recently seen clients are tracked.
+    """
+
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def tokens(self, client, now):
+        tokens, updated = self.buckets.pop(client, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allowed(self, client):
+        """Returns whether client has a token left, without taking it"""
+
+        now = time.time()
+        with self.lock:
+            if client not in self.buckets:
+                return True
+            tokens = self.tokens(client, now)
+            self.buckets[client] = (tokens, now)
+            return tokens >= 1
+
+    def consume(self, client):
+        now = time.time()
+        with self.lock:
+            tokens = self.tokens(client, now)
+            self.buckets[client] = (max(0, tokens - 1), now)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+
+UNKNOWN_MACS = ExpiringSet(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE)
+MISSING_STATIC = ExpiringSet(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE)
+MISS_BUCKETS = TokenBuckets(MISS_RATE, MISS_BURST, NEGATIVE_CACHE_SIZE)
+
+_TEMPLATE_DEPS = {}
+
+def template_dependencies(env, name):
+    """Finds what a template and everything it includes, extends or imports reads
+
+    :return Tuple of (context variable names, template names, model_misc keys,
+        loader uptodate callables). The model_misc keys hold '*' when the
+        template reads model_misc other than through constant keys, and the
+        template names hold '*' when an include is not a constant.
+    :rtype tuple
+    """
+
+    variables, templates, model_misc_keys, uptodates = set(), set(), set(), []
+    pending = [name]
+    while pending:
+        current = pending.pop()
+        if current in templates:
+            continue
+        templates.add(current)
+        source, _filename, uptodate = env.loader.get_source(env, current)
+        uptodates.append(uptodate)
+        cache_key = (id(env), current)
+        cached = _TEMPLATE_DEPS.get(cache_key)
+        if cached is None or cached[0] != source:
+            ast = env.parse(source)
+            keys = set()
+            keyed = 0
+            for node in ast.find_all(nodes.Getitem):
+                if isinstance(node.node, nodes.Name) and node.node.name == 'model_misc' and isinstance(node.arg, nodes.Const):
+                    keys.add(node.arg.value)
+                    keyed += 1
+            for node in ast.find_all(nodes.Call):
+                attr = node.node
+                if (isinstance(attr, nodes.Getattr) and attr.attr == 'get' and isinstance(attr.node, nodes.Name) and
+                        attr.node.name == 'model_misc' and node.args and isinstance(node.args[0], nodes.Const)):
+                    keys.add(node.args[0].value)
+                    keyed += 1
+            loads = [n for n in ast.find_all(nodes.Name) if n.name == 'model_misc' and n.ctx == 'load']
+            if len(loads) > keyed:
+                keys.add('*')
+            cached = (source, meta.find_undeclared_variables(ast), list(meta.find_referenced_templates(ast)), keys)
+            _TEMPLATE_DEPS[cache_key] = cached
+        variables.update(cached[1])
+        model_misc_keys.update(cached[3])
+        for referenced in cached[2]:
+            if referenced is None:
+                templates.add('*')
+            else:
+                pending.append(referenced)
+    return variables, templates, model_misc_keys, uptodates
+
+_OUTPUT_DEPS = {}
+
+def template_output_dependencies(env, template_path):
+    """Lists the inputs a template's output depends on, other than the phone
+
+    Kept until one of the template files read changes, so checking the same
+    template for many phones stats its files instead of reading and parsing
+    them again.
+
+    :return Tuple of (frozenset of dependencies, whether the output may be cached)
+    :rtype tuple
+    """
+
+    cache_key = (id(env), getattr(env, 'fragment_cache_version', None), template_path)
+    cached = _OUTPUT_DEPS.get(cache_key)
+    if cached is not None and all(uptodate is None or uptodate() for uptodate in cached[0]):
+        return cached[1]
+    variables, templates, model_misc_keys, uptodates = template_dependencies(env, template_path)
+    deps = set(('template', t) for t in templates)
+    deps.update(('setting', column) for column in SETTINGS_COLUMNS if column in variables)
+    if 'model_misc' in variables:
+        deps.update(('model_misc', key) for key in model_misc_keys)
+    if 'directory' in variables:
+        deps.add(('directory', ))
+    result = (frozenset(deps), 'environ' not in variables and '*' not in templates)
+    if len(_OUTPUT_DEPS) >= RENDER_CACHE_SIZE:
+        _OUTPUT_DEPS.clear()
+    _OUTPUT_DEPS[cache_key] = (uptodates, result)
+    return result
+
+def phone_dependencies(phone):
+    """Lists the inputs of a phone's own files that come from the phone and FreePBX"""
+
+    deps = set([('phone', phone['mac']), ('backends', )])
+    for ext in phone.get('lines') or [phone['extension']]:
+        deps.add(('pbx', phone['backend']['name'], ext))
+    return deps
+
+def output_dependencies(env, template_path, phone=None):
+    """Lists the inputs a rendered output depends on
+
+    Dependencies are tuples such as ('setting', column), ('model_misc', model),
+    ('phone', mac), ('pbx', backend, extension), ('backends', ), ('directory', )
+    and ('template', path).
+
+    :return Tuple of (set of dependencies, whether the output may be cached)
+    :rtype tuple
+    """
+
+    deps, cacheable = template_output_dependencies(env, template_path)
+    deps = set(deps)
+    if phone is not None:
+        deps |= phone_dependencies(phone)
+    return deps, cacheable
+
+def dependency_matches(change, deps):
+    """Returns whether a changed input affects an output with the given dependencies"""
+
+    if change in deps:
+        return True
+    if change[-1] == '*':
+        return any(dep[:len(change) - 1] == change[:-1] for dep in deps)
+    return change[:-1] + ('*', ) in deps
+
+class RenderCache(object):
+    """Bounded cache of rendered outputs, invalidated by the inputs they depend on
+
+    :param size Most entries kept
+    :param max_bytes Most total weight kept, where put is given each entry's weight
+    """
+
+    def __init__(self, size, max_bytes=None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, stale=False):
+        """Returns a cached output, or None when it is missing or expired
+
+        Expired outputs are kept until they are replaced, invalidated or
+        evicted, and stale=True returns them anyway.
+        """
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            if entry[2] < time.time() and not stale:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, deps, ttl, weight=0):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, deps, time.time() + ttl, weight)
+            self.bytes += weight
+            for dep in deps:
+                self.index.setdefault(dep, set()).add(key)
+            while len(self.entries) > self.size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """Drops one entry, with the lock held"""
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[3]
+            self.unindex(key, entry[1])
+
+    def unindex(self, key, deps):
+        for dep in deps:
+            keys = self.index.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[dep]
+
+    def invalidate(self, changes):
+        """Drops every output depending on one of changes
+
+        :return Number of outputs dropped
+        :rtype int
+        """
+
+        # Deps that match a change are the change itself and its wildcard
+        # parents, looked up directly. Only changes ending in '*' need a scan,
+        # which runs on a copy of the index keys outside the lock.
+        deps = set()
+        prefixes = []
+        for change in changes:
+            change = tuple(change)
+            deps.add(change)
+            deps.update(change[:i] + ('*', ) for i in range(len(change) + 1))
+            if change[-1] == '*':
+                prefixes.append(change[:-1])
+        if prefixes:
+            with self.lock:
+                indexed = list(self.index)
+            deps.update(dep for dep in indexed if any(dep[:len(p)] == p for p in prefixes))
+        with self.lock:
+            keys = set()
+            for dep in deps:
+                keys.update(self.index.get(dep, ()))
+        keys = list(keys)
+        # Removed in batches so requests can get at the cache in between
+        for start in range(0, len(keys), 1000):
+            with self.lock:
+                for key in keys[start:start + 1000]:
+                    self.remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.index.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_SIZE)
+FRAGMENT_CACHE = RenderCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_BYTES)
+
+def invalidate_outputs(changes):
+    """Drops cached outputs depending on changes and forgets MACs that were added"""
+
+    RENDER_CACHE.invalidate(changes)
+    FRAGMENT_CACHE.invalidate(changes)
+    for change in changes:
+        if change[0] == 'phone' and change[-1] == '*':
+            UNKNOWN_MACS.clear()
+        elif change[0] == 'phone':
+            UNKNOWN_MACS.discard((LOCAL_SOURCE.version, change[1]))
+
+class FragmentCacheExtension(Extension):
+    """Adds {% cache key, ttl, tags %}...{% endcache %} to templates
+
+    The output of the block is kept in FRAGMENT_CACHE under key for ttl
+    seconds, or FRAGMENT_CACHE_TTL when ttl is left out or none. Keys must
+    cover everything the block reads that varies between phones, such as
+    the model or the extension. A cached block is dropped when its template
+    changes or when one of the optional tags changes. tags is a string or a
+    list of strings naming the inputs that change_log records, such as 'setting:ntp_server',
+    'model_misc:Yealink/T46S', 'directory' or 'backends'.
+    """
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        environment.extend(fragment_cache_version=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        while len(args) < 4 and parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        while len(args) < 4:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('render_fragment', args), [], [], body).set_lineno(lineno)
+
+    def render_fragment(self, name, key, ttl, tags, caller):
+        try:
+            ttl = FRAGMENT_CACHE_TTL if ttl is None or isinstance(ttl, Undefined) else int(ttl)
+        except (TypeError, ValueError):
+            ttl = FRAGMENT_CACHE_TTL
+        if ttl <= 0:
+            return caller()
+        cache_key = (self.environment.fragment_cache_version, name, key)
+        output = FRAGMENT_CACHE.get(cache_key)
+        if output is None:
+            output = caller()
+            if isinstance(tags, TEXT_TYPES):
+                tags = [tags]
+            deps = set([('template', name)])
+            deps.update(tuple(tag.split(':')) for tag in tags or ())
+            FRAGMENT_CACHE.put(cache_key, output, deps, ttl, len(to_bytes(output)))
+        return output
+
+TEMPLATE_ENV.add_extension(FragmentCacheExtension)
+
+class SingleFlight(object):
+    """Runs one call per key at a time, handing its result to callers that arrive meanwhile
+
+    :param waited Number of calls that shared another call's result
+    :type waited int
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.waited = 0
+
+    def join(self, key):
+        """Starts a call for key, or waits for the one in progress to finish
+
+        :return Tuple of (whether this caller leads, the call). A leader must
+            pass the call to finish. For the others the call already holds the
+            leader's 'result' or 'error'.
+        :rtype tuple
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.waited += 1
+        if not leader:
+            call['event'].wait()
+        return leader, call
+
+    def finish(self, key, call, result=None, error=None):
+        call['result'] = result
+        call['error'] = error
+        with self.lock:
+            del self.calls[key]
+        call['event'].set()
+
+    def do(self, key, func):
+        leader, call = self.join(key)
+        if not leader:
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        result = error = None
+        try:
+            result = func()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.finish(key, call, result, error)
+        return result
+
+RENDER_FLIGHTS = SingleFlight()
+
+def render_flight_key(source, template_path, context, deps):
+    """Identifies a model-wide render by its template and every input it reads"""
+
+    mtimes = getattr(source, 'template_mtimes', None) or {}
+    inputs = [source.version, template_path, context['phone_server'], context['ntp_server'], context['model_misc'],
+              sorted((d[1], mtimes.get(d[1])) for d in deps if d[0] == 'template')]
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+_SHARE_SWEEP = {'at': 0}
+
+def sweep_render_share(now):
+    """Deletes outputs in RENDER_SHARE_DIR too old to be reused, at most once per SINGLE_FLIGHT_TTL"""
+
+    if now - _SHARE_SWEEP['at'] < SINGLE_FLIGHT_TTL:
+        return
+    _SHARE_SWEEP['at'] = now
+    try:
+        names = os.listdir(RENDER_SHARE_DIR)
+    except OSError as e:
+        print(e)
+        return
+    for name in names:
+        if name.startswith('lock-'):
+            continue
+        path = os.path.join(RENDER_SHARE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) >= SINGLE_FLIGHT_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+def shared_render(key, render):
+    """Renders once across processes sharing RENDER_SHARE_DIR
+
+    The first process to lock the key renders and writes the output, the
+    others wait on the lock and read it. Keys share a fixed set of
+    RENDER_SHARE_LOCKS lock files, and outputs older than SINGLE_FLIGHT_TTL
+    are rendered again and swept away by whoever renders next. Without
+    RENDER_SHARE_DIR or fcntl, render is just called.
+    """
+
+    if RENDER_SHARE_DIR is None:
+        return render()
+    try:
+        import fcntl
+    except ImportError:
+        return render()
+    path = os.path.join(RENDER_SHARE_DIR, key)
+    slot = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % RENDER_SHARE_LOCKS
+    with open(os.path.join(RENDER_SHARE_DIR, 'lock-{}'.format(slot)), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                if time.time() - os.path.getmtime(path) < SINGLE_FLIGHT_TTL:
+                    with io.open(path, 'r', encoding='utf-8') as f:
+                        return f.read()
+            except (IOError, OSError):
+                pass
+            output = render()
+            tmp_path = '{}.{}'.format(path, os.getpid())
+            with io.open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(output)
+            os.rename(tmp_path, path)
+            return output
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            sweep_render_share(time.time())
+
+_CHANGES = {'seq': None, 'polled': 0}
+_CHANGES_LOCK = threading.Lock()
+
+def record_change(db, changes):
+    """Logs changed inputs in the open transaction for every process to invalidate
+
+    The caller commits. The local caches are invalidated straight away.
+
+    :param db Open sqlite connection
+    :type db sqlite3.Connection
+    :param changes Dependency tuples that changed
+    :type changes list
+    """
+
+    now = time.time()
+    db.executemany('INSERT INTO change_log VALUES (?, ?)', [(now, json.dumps(list(c))) for c in changes])
+    db.execute('DELETE FROM change_log WHERE created < ?', (now - CHANGE_LOG_RETENTION, ))
+    invalidate_outputs(changes)
+
+def poll_changes():
+    """Applies changes logged by other processes, at most every CHANGE_POLL_INTERVAL seconds"""
+
+    now = time.time()
+    if now - _CHANGES['polled'] < CHANGE_POLL_INTERVAL or not _CHANGES_LOCK.acquire(False):
+        return
+    try:
+        _CHANGES['polled'] = now
+        db = connect_db()
+        try:
+            if _CHANGES['seq'] is None:
+                _CHANGES['seq'] = db.execute('SELECT MAX(rowid) FROM change_log').fetchone()[0] or 0
+                return
+            c = db.execute('SELECT rowid, dependency FROM change_log WHERE rowid > ? ORDER BY rowid', (_CHANGES['seq'], ))
+            rows = c.fetchall()
+        finally:
+            db.close()
+        if rows:
+            _CHANGES['seq'] = rows[-1][0]
+            invalidate_outputs([tuple(json.loads(r[1])) for r in rows])
+    except sqlite3.OperationalError as e:
+        print(e)
+    finally:
+        _CHANGES_LOCK.release()
+
+def model_files(source, brand, model):
+    """Returns (templatefile, has mac group) for every urls pattern of a model"""
+
+    files = []
+    for b, m, urls in source.model_urls():
+        if (b, m) != (brand, model):
+            continue
+        for url in urls:
+            m2 = re.search(RE_COMMENT_PATTERN, url)
+            if m2:
+                files.append((m2.group('templatefile'), '(?P<mac>' in url))
+    return files
+
+def affected_phones(db, changes, source=None):
+    """Returns the phones whose provisioning files depend on one of changes
+
+    Both the phone's own files and the model-wide files its model serves count.
+
+    :return List of phone dicts with their backend resolved
+    :rtype list
+    """
+
+    if source is None:
+        source = LOCAL_SOURCE
+    backends = get_backends(db)
+    phones = [phone_from_row(r) for r in db.execute('SELECT * FROM ext_mac_map').fetchall()]
+    # The template side of each model's files is worked out once, and only
+    # the phone's own inputs are added per phone
+    model_deps = {}
+    affected = []
+    for phone in phones:
+        if not phone['template'] or phone['template'].count('/') != 1:
+            continue
+        phone['backend'] = resolve_backend(backends, phone['extension'], phone['backend'])
+        if phone['template'] not in model_deps:
+            brand, model = phone['template'].split('/')
+            deps, has_mac_file = set(), False
+            for templatefile, has_mac in model_files(source, brand, model):
+                try:
+                    deps |= template_output_dependencies(source.template_env, os.path.join(brand, model, templatefile))[0]
+                except TemplateNotFound:
+                    continue
+                has_mac_file = has_mac_file or has_mac
+            model_deps[phone['template']] = (deps, has_mac_file)
+        deps, has_mac_file = model_deps[phone['template']]
+        if has_mac_file:
+            deps = deps | phone_dependencies(phone)
+        if any(dependency_matches(change, deps) for change in changes):
+            affected.append(phone)
+    return affected
+
+def affected_message(db, changes):
+    count = len(affected_phones(db, changes))
+    return '{} phone{} affected.'.format(count, '' if count == 1 else 's')
+
+def check_template_changes(source):
+    """Invalidates outputs built from template files changed since the last check"""
+
+    mtimes = {}
+    for root, _dirs, files in os.walk(source.templates_folder):
+        for fn in files:
+            full_path = os.path.join(root, fn)
+            try:
+                mtimes[os.path.relpath(full_path, source.templates_folder).replace(os.sep, '/')] = os.path.getmtime(full_path)
+            except OSError:
+                continue
+    previous = source.template_mtimes
+    source.template_mtimes = mtimes
+    if previous is None:
+        return
+    changed = [('template', name) for name in set(mtimes) | set(previous) if mtimes.get(name) != previous.get(name)]
+    if changed:
+        invalidate_outputs(changed)
+
+_FETCHES = {'pending': [], 'timer': None, 'enabled': True}
+_FETCHES_LOCK = threading.Lock()
+
+def observe_fetch(mac, elapsed):
+    """Notes that a phone fetched its config, written to fetch_log within FETCH_FLUSH_INTERVAL seconds"""
+
+    with _FETCHES_LOCK:
+        if not _FETCHES['enabled']:
+            return
+        _FETCHES['pending'].append((mac, time.time(), elapsed))
+        if _FETCHES['timer'] is None:
+            timer = _FETCHES['timer'] = threading.Timer(FETCH_FLUSH_INTERVAL, flush_fetches)
+            timer.daemon = True
+            timer.start()
+
+def flush_fetches():
+    with _FETCHES_LOCK:
+        pending, _FETCHES['pending'] = _FETCHES['pending'], []
+        _FETCHES['timer'] = None
+    if not pending:
+        return
+    try:
+        db = connect_db()
+        try:
+            db.executemany('INSERT INTO fetch_log VALUES (?, ?, ?)', pending)
+            db.execute('DELETE FROM fetch_log WHERE fetched < ?', (time.time() - CHANGE_LOG_RETENTION, ))
+            db.commit()
+        finally:
+            db.close()
+    except sqlite3.OperationalError as e:
+        print(e)
+
+class AMIError(Exception):
+    pass
+
+class AMIClient(object):
+    """Minimal Asterisk Manager Interface client for sending check-sync NOTIFYs"""
+
+    def __init__(self, host, port, username, secret, channel_driver='pjsip', timeout=5):
+        self.channel_driver = channel_driver
+        self.action_id = 0
+        self.sock = socket.create_connection((host, int(port)), timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.rfile.readline()
+        self.action('Login', Username=username, Secret=secret, Events='off')
+
+    def action(self, name, **fields):
+        """Sends an action and returns its response as a dict, raising AMIError on failure"""
+
+        self.action_id += 1
+        lines = ['Action: {}'.format(name), 'ActionID: {}'.format(self.action_id)]
+        lines.extend('{}: {}'.format(k, v) for k, v in fields.items())
+        self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8'))
+        while True:
+            response = {}
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    raise AMIError('Connection closed by Asterisk')
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if not line:
+                    break
+                key, _sep, value = line.partition(':')
+                response[key.strip()] = value.strip()
+            if response.get('ActionID') == str(self.action_id):
+                break
+        if response.get('Response') != 'Success':
+            raise AMIError('{} failed: {}'.format(name, response.get('Message', response)))
+        return response
+
+    def notify(self, extension):
+        if self.channel_driver == 'sip':
+            self.action('SIPnotify', Channel='SIP/{}'.format(extension), Variable='Event=check-sync')
+        else:
+            self.action('PJSIPNotify', Endpoint=extension, Variable='Event=check-sync')
+
+    def close(self):
+        try:
+            self.action('Logoff')
+        except (AMIError, socket.error):
+            pass
+        self.rfile.close()
+        self.sock.close()
+
+class DryRunAMIClient(object):
+    """Stands in for AMIClient and only records which extensions would be notified"""
+
+    def __init__(self, *args, **kwargs):
+        self.notified = []
+
+    def notify(self, extension):
+        self.notified.append(extension)
+
+    def close(self):
+        pass
+
+def get_ami_settings(db):
+    """Returns AMI connection settings per backend name, defaulting the host to the MySQL host"""
+
+    ami = {}
+    for backend in get_backends(db):
+        ami[backend['name']] = {'host': backend['mysql_host'], 'port': 5038, 'username': '', 'secret': '', 'channel_driver': 'pjsip'}
+    for r in db.execute('SELECT * FROM ami_settings').fetchall():
+        if r[0] in ami:
+            ami[r[0]].update({'host': r[1] or ami[r[0]]['host'], 'port': r[2] or 5038,
+                              'username': r[3], 'secret': r[4], 'channel_driver': r[5] or 'pjsip'})
+    return ami
+
+class ResyncScheduler(object):
+    """Makes a set of phones re-fetch their configs without a boot storm
+
+    check-sync NOTIFYs go out in waves of RESYNC_WAVE phones with random
+    jitter between them. A phone counts as done once fetch_log shows it
+    fetching its config after being notified. The rate is halved whenever
+    the average provisioning time of those fetches exceeds
+    RESYNC_TARGET_LATENCY and raised step by step otherwise.
+
+    :param phones Phone dicts with mac, extension and resolved backend
+    :type phones list
+    :param client_factory Called with an AMI settings dict, returns an AMIClient or compatible object
+    :param progress Called with the scheduler after every phone, wave and fetch
+        check. An exception it raises stops the run before the next NOTIFY.
+    :param wait Whether to keep checking for re-fetches after the last wave
+    """
+
+    def __init__(self, phones, ami_settings, client_factory=AMIClient, rate=RESYNC_RATE, progress=None, wait=True):
+        self.phones = list(phones)
+        self.ami_settings = ami_settings
+        self.client_factory = client_factory
+        self.rate = rate
+        self.sent = {}
+        self.done = set()
+        self.failed = {}
+        self.latency = None
+        self.cancelled = False
+        self.finished = False
+        self.clients = {}
+        self.progress = progress
+        self.wait = wait
+
+    def client(self, backend_name):
+        client = self.clients.get(backend_name)
+        if client is None:
+            settings = self.ami_settings[backend_name]
+            client = self.clients[backend_name] = self.client_factory(
+                settings['host'], settings['port'], settings['username'], settings['secret'], settings['channel_driver'])
+        return client
+
+    def status(self):
+        return {
+            'total': len(self.phones),
+            'sent': len(self.sent),
+            'done': len(self.done),
+            'failed': len(self.failed),
+            'rate': round(self.rate, 2),
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'finished': self.finished,
+            'cancelled': self.cancelled,
+        }
+
+    def check_fetches(self):
+        if not self.sent:
+            return
+        db = connect_db()
+        try:
+            first_sent = min(self.sent.values())
+            c = db.execute('SELECT mac, fetched, elapsed FROM fetch_log WHERE fetched >= ?', (first_sent, ))
+            rows = c.fetchall()
+        finally:
+            db.close()
+        elapsed = []
+        for mac, fetched, fetch_elapsed in rows:
+            if mac in self.sent and fetched >= self.sent[mac]:
+                self.done.add(mac)
+                elapsed.append(fetch_elapsed)
+        if elapsed:
+            self.latency = sum(elapsed) / len(elapsed)
+            if self.latency > RESYNC_TARGET_LATENCY:
+                self.rate = max(RESYNC_MIN_RATE, self.rate / 2)
+            else:
+                self.rate = min(RESYNC_MAX_RATE, self.rate + RESYNC_RATE_STEP)
+
+    def run(self):
+        pending = list(self.phones)
+        try:
+            while pending and not self.cancelled:
+                wave, pending = pending[:RESYNC_WAVE], pending[RESYNC_WAVE:]
+                for phone in wave:
+                    if self.cancelled:
+                        break
+                    self.sent[phone['mac']] = time.time()
+                    try:
+                        self.client(phone['backend']['name']).notify(phone['extension'])
+                    except (AMIError, socket.error) as e:
+                        del self.sent[phone['mac']]
+                        self.failed[phone['mac']] = str(e)
+                        self.clients.pop(phone['backend']['name'], None)
+                    if self.progress is not None:
+                        self.progress(self)
+                    time.sleep(random.uniform(0, RESYNC_JITTER) / self.rate)
+                time.sleep(len(wave) / self.rate)
+                self.check_fetches()
+                if self.progress is not None:
+                    self.progress(self)
+            deadline = time.time() + RESYNC_COMPLETION_TIMEOUT
+            while self.wait and not self.cancelled and len(self.done) < len(self.sent) and time.time() < deadline:
+                time.sleep(FETCH_FLUSH_INTERVAL)
+                self.check_fetches()
+                if self.progress is not None:
+                    self.progress(self)
+        finally:
+            for client in self.clients.values():
+                client.close()
+            self.finished = True
+
+def select_phones(db, template='', ext_start='', ext_end='', macs=None, changed_since=None):
+    """Picks phones by model, extension range, MAC list or changes logged since a time
+
+    Every given filter must match.
+    """
+
+    backends = get_backends(db)
+    phones = [phone_from_row(r) for r in db.execute('SELECT * FROM ext_mac_map ORDER BY extension').fetchall()]
+    if changed_since is not None:
+        c = db.execute('SELECT dependency FROM change_log WHERE created >= ?', (changed_since, ))
+        changes = [tuple(json.loads(r[0])) for r in c.fetchall()]
+        affected = set(p['mac'] for p in affected_phones(db, changes))
+        phones = [p for p in phones if p['mac'] in affected]
+    if template:
+        phones = [p for p in phones if p['template'] == template]
+    if ext_start or ext_end:
+        phones = [p for p in phones if ext_in_range(p['extension'], ext_start, ext_end)]
+    if macs:
+        macs = set(m.replace(':', '').lower() for m in macs)
+        phones = [p for p in phones if p['mac'] in macs]
+    for phone in phones:
+        phone['backend'] = resolve_backend(backends, phone['extension'], phone['backend'])
+    return phones
+
+class JobCancelled(Exception):
+    pass
+
+class Job(object):
+    """Handle a job function reports progress through
+
+    :param rowid Row of the job in the jobs table
+    :type rowid int
+    :param params Arguments the job was submitted with
+    :type params dict
+    :param checkpoint Last checkpoint saved by an earlier run, {} on the first run
+    :type checkpoint dict
+    """
+
+    def __init__(self, rowid, kind, params, checkpoint, runner=None):
+        self.rowid = rowid
+        self.kind = kind
+        self.params = params
+        self.checkpoint = checkpoint
+        self.runner = runner
+
+    def progress(self, done, total=None, message=None, checkpoint=None):
+        """Saves progress and the checkpoint to resume from after a restart
+
+        Raises JobCancelled once the job has been cancelled, or when it went
+        stale and another runner took it over.
+        """
+
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        db = connect_db()
+        try:
+            c = db.execute('''UPDATE jobs SET done=?, total=COALESCE(?, total), message=COALESCE(?, message),
+                              checkpoint=?, heartbeat=? WHERE rowid=? AND runner=?''',
+                           (done, total, message, json.dumps(self.checkpoint), time.time(), self.rowid, self.runner))
+            state = db.execute('SELECT state FROM jobs WHERE rowid=?', (self.rowid, )).fetchone()[0]
+            db.commit()
+        finally:
+            db.close()
+        if c.rowcount == 0 or state != 'running':
+            raise JobCancelled()
+
+def submit_job(db, kind, params):
+    """Queues a job in the open transaction and makes sure this process runs jobs
+
+    :param kind Key of JOB_HANDLERS
+    :type kind str
+    :return rowid of the job
+    :rtype int
+    """
+
+    now = time.time()
+    c = db.execute('''INSERT INTO jobs (kind, params, state, done, total, message, checkpoint, created, heartbeat)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                   (kind, json.dumps(params), 'queued', 0, None, '', '{}', now, now))
+    start_job_runner()
+    return c.lastrowid
+
+def cancel_job(db, rowid):
+    db.execute("UPDATE jobs SET state='cancelled' WHERE rowid=? AND state='queued'", (rowid, ))
+    db.execute("UPDATE jobs SET state='cancelling' WHERE rowid=? AND state='running'", (rowid, ))
+
+def resume_job(db, rowid):
+    db.execute("UPDATE jobs SET state='queued', message='' WHERE rowid=? AND state IN ('failed', 'cancelled')", (rowid, ))
+    start_job_runner()
+
+def job_from_row(row):
+    keys = ('id', 'kind', 'params', 'state', 'done', 'total', 'message', 'checkpoint', 'created', 'heartbeat')
+    job = dict(zip(keys, row))
+    job['params'] = json.loads(job['params'])
+    job.pop('checkpoint')
+    return job
+
+def get_jobs(db, kind=None, limit=50):
+    if kind is None:
+        c = db.execute('SELECT rowid,* FROM jobs ORDER BY rowid DESC LIMIT ?', (limit, ))
+    else:
+        c = db.execute('SELECT rowid,* FROM jobs WHERE kind=? ORDER BY rowid DESC LIMIT ?', (kind, limit))
+    return [job_from_row(r) for r in c.fetchall()]
+
+def claim_job():
+    """Marks the oldest queued job as running, taking over jobs whose runner stopped heartbeating
+
+    Each claim stores a new runner id, so a runner whose job was taken over
+    can no longer save progress or finish it.
+
+    :return Job or None when there is nothing to run
+    :rtype Job
+    """
+
+    now = time.time()
+    db = connect_db()
+    try:
+        db.execute("UPDATE jobs SET state='cancelled' WHERE state='cancelling' AND heartbeat < ?", (now - JOB_STALE, ))
+        db.execute("UPDATE jobs SET state='queued' WHERE state='running' AND heartbeat < ?", (now - JOB_STALE, ))
+        db.commit()
+        while True:
+            row = db.execute("SELECT rowid, kind, params, checkpoint FROM jobs WHERE state='queued' ORDER BY rowid LIMIT 1").fetchone()
+            if row is None:
+                return None
+            runner = uuid.uuid4().hex
+            c = db.execute("UPDATE jobs SET state='running', heartbeat=?, runner=? WHERE rowid=? AND state='queued'",
+                           (now, runner, row[0]))
+            db.commit()
+            if c.rowcount == 1:
+                return Job(row[0], row[1], json.loads(row[2]), json.loads(row[3] or '{}'), runner)
+    finally:
+        db.close()
+
+def finish_job(job, state, message=None):
+    db = connect_db()
+    try:
+        db.execute('UPDATE jobs SET state=?, message=COALESCE(?, message), heartbeat=? WHERE rowid=? AND runner=?',
+                   (state, message, time.time(), job.rowid, job.runner))
+        db.commit()
+    finally:
+        db.close()
+
+def heartbeat_job(job, stop):
+    """Refreshes a running job's heartbeat until stop is set
+
+    Keeps the job from looking stale while its handler waits between
+    progress calls, on timeouts or pacing sleeps.
+    """
+
+    while not stop.wait(JOB_STALE / 4.0):
+        try:
+            db = connect_db()
+            try:
+                db.execute('UPDATE jobs SET heartbeat=? WHERE rowid=? AND runner=?', (time.time(), job.rowid, job.runner))
+                db.commit()
+            finally:
+                db.close()
+        except sqlite3.OperationalError as e:
+            print(e)
+
+def run_job(job):
+    handler = JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        finish_job(job, 'failed', 'Unknown job kind {}'.format(job.kind))
+        return
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=heartbeat_job, args=(job, stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+        handler(job)
+    except JobCancelled:
+        finish_job(job, 'cancelled')
+    except Exception as e:
+        print(e)
+        finish_job(job, 'failed', '{}: {}'.format(type(e).__name__, e))
+    else:
+        finish_job(job, 'done')
+    finally:
+        stop.set()
+
+def job_worker():
+    while True:
+        try:
+            job = claim_job()
+        except sqlite3.OperationalError as e:
+            print(e)
+            job = None
+        if job is None:
+            _JOB_RUNNER['wake'].wait(JOB_POLL_INTERVAL)
+            _JOB_RUNNER['wake'].clear()
+            continue
+        run_job(job)
+
+_JOB_RUNNER = {'threads': [], 'wake': threading.Event()}
+_JOB_RUNNER_LOCK = threading.Lock()
+
+def start_job_runner(threads=JOB_THREADS):
+    """Starts the job threads of this process once, or wakes them up"""
+
+    with _JOB_RUNNER_LOCK:
+        if not _JOB_RUNNER['threads']:
+            for _i in range(threads):
+                t = threading.Thread(target=job_worker)
+                t.daemon = True
+                t.start()
+                _JOB_RUNNER['threads'].append(t)
+    _JOB_RUNNER['wake'].set()
+
+def import_phones_job(job):
+    """Adds or updates phones from "extension,mac[,model]" lines, JOB_BATCH lines per transaction"""
+
+    lines = [l.strip() for l in job.params.get('lines', []) if l.strip()]
+    start = job.checkpoint.get('line', 0)
+    errors = job.checkpoint.get('errors', [])
+    for i in range(start, len(lines), JOB_BATCH):
+        db = connect_db()
+        try:
+            macs = []
+            for n, line in enumerate(lines[i:i + JOB_BATCH], i + 1):
+                fields = [f.strip() for f in line.split(',')]
+                if len(fields) < 2 or not fields[0] or not fields[1]:
+                    errors.append('Line {}: expected extension,mac[,model]'.format(n))
+                    continue
+                ext, mac = fields[0], fields[1].replace(':', '').lower()
+                template = fields[2] if len(fields) > 2 else ''
+                if db.execute('SELECT 1 FROM ext_mac_map WHERE mac=?', (mac, )).fetchone():
+                    db.execute('UPDATE ext_mac_map SET extension=?, template=CASE WHEN ?='' THEN template ELSE ? END WHERE mac=?',
+                               (ext, template, template, mac))
+                else:
+                    db.execute('INSERT INTO ext_mac_map (extension, mac, template, misc, backend) VALUES (?, ?, ?, ?, ?)',
+                               (ext, mac, template, '', ''))
+                macs.append(mac)
+            record_change(db, [('phone', mac) for mac in macs])
+            db.commit()
+        finally:
+            db.close()
+        for mac in macs:
+            UNKNOWN_MACS.discard((LOCAL_SOURCE.version, mac))
+        done = min(i + JOB_BATCH, len(lines))
+        job.progress(done, len(lines), '; '.join(errors[-5:]), {'line': done, 'errors': errors})
+
+def compile_templates_job(job):
+    """Compiles every template file to find syntax errors and warm the template cache"""
+
+    names = sorted(n for n in TEMPLATE_ENV.list_templates() if os.path.basename(n) != 'urls')
+    errors = job.checkpoint.get('errors', [])
+    for i in range(job.checkpoint.get('index', 0), len(names)):
+        try:
+            TEMPLATE_ENV.get_template(names[i])
+        except Exception as e:
+            errors.append('{}: {}'.format(names[i], e))
+        if (i + 1) % JOB_BATCH == 0 or i + 1 == len(names):
+            job.progress(i + 1, len(names), '; '.join(errors[-5:]) or 'No errors', {'index': i + 1, 'errors': errors})
+
+def resync_params_error(params):
+    """Returns what is wrong with the params of a resync job, or None"""
+
+    if not isinstance(params, dict) or not isinstance(params.get('filter', {}), dict):
+        return 'params must be {"filter": {...}, "dry_run": ...}'
+    selection = params.get('filter', {})
+    unknown = set(selection) - set(['template', 'ext_start', 'ext_end', 'macs', 'changed_since'])
+    if unknown:
+        return 'Unknown filter {}'.format(', '.join(sorted(unknown)))
+    changed_since = selection.get('changed_since')
+    if changed_since is not None and (isinstance(changed_since, bool) or not isinstance(changed_since, (int, float))):
+        return 'changed_since must be a timestamp'
+    if not isinstance(selection.get('macs') or [], list):
+        return 'macs must be a list'
+    return None
+
+def resync_job(job):
+    """Runs a ResyncScheduler over the phones selected by the job's params, skipping phones already notified"""
+
+    db = connect_db()
+    try:
+        phones = select_phones(db, **job.params.get('filter', {}))
+        ami = get_ami_settings(db)
+    finally:
+        db.close()
+    sent = set(job.checkpoint.get('sent', []))
+    phones = [p for p in phones if p['mac'] not in sent]
+    client_factory = DryRunAMIClient if job.params.get('dry_run') else AMIClient
+
+    def progress(scheduler):
+        status = scheduler.status()
+        message = 'Sent {sent} of {total}, {done} re-fetched, {failed} failed, {rate} phones/s'.format(**status)
+        if status['latency'] is not None:
+            message += ', average provisioning time {}s'.format(status['latency'])
+        job.progress(len(sent) + status['sent'], len(sent) + status['total'], message,
+                     {'sent': sorted(sent | set(scheduler.sent))})
+
+    ResyncScheduler(phones, ami, client_factory, progress=progress, wait=not job.params.get('dry_run')).run()
+
+JOB_HANDLERS = {
+    'import_phones': import_phones_job,
+    'compile_templates': compile_templates_job,
+    'resync': resync_job,
+}
+
+def stale_response(cache_key):
+    """Returns the last output cached under cache_key flagged as stale, or None if there is none"""
+
+    cached = RENDER_CACHE.get(cache_key, stale=True)
+    if cached is None:
+        return None
+    body, header, _mac = cached
+    return AppResponse(body, STATUS['OK'], header + [ STALE_WARNING ])
+
+def template_context(environ, source, settings, phone=None, pbx_users=None):
+    """Builds the variables a urls template is rendered with
+
+    :param phone Phone dict from source.lookup for templates with a mac group
+    :param pbx_users {extension: (secret, name)} of the phone's lines, with
+        an entry for its own extension
+    :rtype dict
+    """
+
+    context = {
+            'environ': environ,
+            'phone_server': settings['phone_server'],
+            'ntp_server': settings['ntp_server'],
+            'model_misc': load_model_misc(settings),
+
+            # Helper Functions
+            'get_def_head': get_def_head,
+            'get_menu': get_menu,
+            'directory': lambda: source.get_directory()['entries'],
+            #'handle_post': handle_custom_post,
+    }
+    if phone is not None:
+        template = phone['template']
+        misc = phone['misc']
+        context['ext'] = phone['extension']
+        context['mac'] = phone['mac']
+        context['template'] = template
+        context['misc'] = misc[template] if template in misc else {}
+        context['backend'] = phone['backend']['name']
+        context['secret'], context['name'] = pbx_users[phone['extension']]
+        context['lines'] = [{'line': n, 'extension': ext, 'secret': pbx_users[ext][0], 'name': pbx_users[ext][1]}
+                            for n, ext in enumerate(phone['lines'], 1) if pbx_users.get(ext)]
+    return context
+
+def check_brand_urls(environ, source=None):
+    #print(environ['PATH_INFO'])
+    started = time.time()
+    path_info = environ.get('PATH_INFO', '')
+    if source is None:
+        source = get_provisioning_source()
+
+    routes = source.model_urls()
+    if source.version is None:
+        poll_changes()
+    cache_key = (source.version, path_info)
+    cached = RENDER_CACHE.get(cache_key)
+    if cached is not None:
+        body, header, mac = cached
+        if mac and source.version is None:
+            observe_fetch(mac, time.time() - started)
+        return AppResponse(body, STATUS['OK'], header)
+
+    for brand, model, urls in routes:
+        for url in urls:
+            #print(url)
+            m = re.search(url, path_info)
+            m2 = re.search(RE_COMMENT_PATTERN, url)
+            if not m or not m2:
+                continue
+            m_dict = m.groupdict()
+            m2_dict = m2.groupdict()
+            mac = m_dict.get('mac', '')
+            if not mac and m2_dict.get('templatefile') == PHONEBOOK_TEMPLATE:
+                return render_phonebook(environ, brand, model, m2_dict.get('format'), source)
+            if mac and (source.version, mac) in UNKNOWN_MACS:
+                return
+            try:
+                with server_timing(environ, 'lookup'):
+                    settings, phone = source.lookup(mac)
+            except IOError as e:
+                print(e)
+                return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
+            except sqlite3.OperationalError as e:
+                print(e)
+                return AppResponse('{}<div class="header">Problem with the database!</div>'.format(get_def_head()), STATUS['ISE'])
+
+            stale = set()
+            pbx_users = None
+            if mac:
+                #print(mac)
+                if not phone:
+                    UNKNOWN_MACS.add((source.version, mac))
+                    return
+                if phone['template'] != '{}/{}'.format(brand, model):
+                    continue
+                try:
+                    with server_timing(environ, 'backend'):
+                        pbx_users = source.get_pbx_users(phone, stale)
+                except CircuitOpen as e:
+                    print(e)
+                    return stale_response(cache_key) or AppResponse(
+                        '{}<div class="header">The Freepbx Mysql DB is unavailable.</div>'.format(get_def_head()),
+                        STATUS['Service Unavailable'], [ HEADER['html'], ('Retry-After', str(BREAKER_COOLDOWN)) ])
+                except IOError as e:
+                    print(e)
+                    return stale_response(cache_key) or AppResponse(
+                        '{}<div class="header">Problem connecting to the Freepbx Mysql DB.</div>'.format(get_def_head()), STATUS['ISE'])
+                except mysql_errors() as e:
+                    print(e)
+                    return stale_response(cache_key) or AppResponse(
+                        '{}<div class="header">Problem with MySQL/MariaDB database.</div>'.format(get_def_head()), STATUS['ISE'])
+                if not pbx_users.get(phone['extension']):
+                    return
+            context = template_context(environ, source, settings, phone if mac else None, pbx_users)
+            templatefile = m2_dict.get('templatefile', '')
+            fmt = m2_dict.get('format')
+            #print(templatefile)
+            #print(fmt)
+            template_path = os.path.join(brand, model, templatefile)
+            render = lambda: source.template_env.get_template(template_path).render(**context)
+            try:
+                with server_timing(environ, 'render'):
+                    deps, cacheable = output_dependencies(source.template_env, template_path, phone if mac else None)
+                    if not cacheable:
+                        # Nothing is kept for the cache, so stream large output as it renders
+                        t = start_stream(source.template_env.get_template(template_path).generate(**context))
+                    elif mac:
+                        t = render()
+                    else:
+                        # Phones of one model booting together all want this file, render it once
+                        flight_key = render_flight_key(source, template_path, context, deps)
+                        t = RENDER_FLIGHTS.do(flight_key, lambda: shared_render(flight_key, render))
+            except TemplateNotFound as e:
+                return AppResponse('{}<div class="header">Template File Missing!</div>{}'.format(get_def_head(), e), STATUS['Not Found'])
+            header = [ HEADER[fmt] if fmt in HEADER else HEADER['html'] ]
+            if stale:
+                header.append(STALE_WARNING)
+            elif cacheable:
+                ttl = RENDER_CACHE_TTL
+                if ('directory', ) in deps:
+                    ttl = min(ttl, DIRECTORY_REFRESH)
+                if mac:
+                    ttl = min(ttl, CREDENTIAL_CACHE_TTL)
+                RENDER_CACHE.put(cache_key, (t, header, mac), deps, ttl)
+            if mac and source.version is None:
+                # Replicas have no prov.db to log fetches to
+                observe_fetch(mac, time.time() - started)
+            return AppResponse(t, STATUS['OK'], header)
+
+def check_static_content(environ, source=None):
+    filename = environ.get('PATH_INFO', '').strip('/')
+    if source is None:
+        source = get_provisioning_source()
+    if (source.version, filename) in MISSING_STATIC:
+        return
+    try:
+        settings, _phone = source.lookup()
+        static_folder = settings['static_folder']
+        path = os.path.join(static_folder, filename)
+        if os.path.exists(path):
+            html_string = open(path, 'rb')
+        else:
+            MISSING_STATIC.add((source.version, filename))
+            return
+    except IOError as e:
+        print(e)
+        return
+    except sqlite3.OperationalError as e:
+        print(e)
+        return
+
+    import mimetypes
+    m_type, _encoding = mimetypes.guess_type(filename)
+    if not m_type:
+        m_type = 'application/octet-stream'
+
+    return AppResponse(html_string, STATUS['OK'], [ ('Content-type', m_type) ])
+
+class ProvisioningBundle(object):
+    """Read-only provisioning data loaded from an exported bundle
+
+    Serves the same lookups as LocalSource without touching prov.db,
+    FreePBX MySQL or the templates folder.
+    """
+
+    def __init__(self, manifest, settings, phones, templates, directory):
+        self.manifest = manifest
+        self.version = manifest['version']
+        self.settings = settings
+        self.phones = phones
+        self.templates = templates
+        self.directory = directory
+        self.template_env = Environment(loader=FunctionLoader(self.load_template), extensions=[FragmentCacheExtension])
+        self.template_env.fragment_cache_version = self.version
+
+    @classmethod
+    def read(cls, path):
+        """Reads and verifies a bundle file
+
+        :return Tuple of (manifest, data, templates)
+        :rtype tuple
+        """
+
+        import tarfile
+        with tarfile.open(path, 'r:gz') as tar:
+            members = dict((m.name, tar.extractfile(m).read()) for m in tar.getmembers() if m.isfile())
+        manifest = json.loads(members.pop('manifest.json').decode('utf-8'))
+        if manifest.get('format') != BUNDLE_FORMAT:
+            raise ValueError('Unsupported bundle format in {}'.format(path))
+        for name, checksum in manifest['files'].items():
+            if name not in members or hashlib.sha256(members[name]).hexdigest() != checksum:
+                raise ValueError('Checksum mismatch for {} in {}'.format(name, path))
+        data = json.loads(members.pop('data.json').decode('utf-8'))
+        templates = dict((name[len('templates/'):], content) for name, content in members.items()
+                         if name.startswith('templates/'))
+        return manifest, data, templates
+
+    @classmethod
+    def load(cls, path):
+        manifest, data, templates = cls.read(path)
+        if manifest['base']:
+            raise ValueError('{} is a delta bundle and needs its base bundle first'.format(path))
+        # Bundles written before the directory was added have none
+        directory = data.get('directory') or {'version': None, 'entries': []}
+        return cls(manifest, data['settings'], data['phones'], templates, directory)
+
+    def apply_delta(self, path):
+        """Returns a new bundle with the delta bundle at path applied on top of this one"""
+
+        manifest, data, templates = self.read(path)
+        if manifest['base'] != self.version:
+            raise ValueError('{} is based on bundle {} not {}'.format(path, manifest['base'], self.version))
+        phones = dict(self.phones)
+        phones.update(data['phones'])
+        for mac in data['removed_phones']:
+            phones.pop(mac, None)
+        new_templates = dict(self.templates)
+        new_templates.update(templates)
+        for name in data['removed_templates']:
+            new_templates.pop(name, None)
+        return ProvisioningBundle(manifest, data['settings'], phones, new_templates, data.get('directory') or self.directory)
+
+    def load_template(self, name):
+        content = self.templates.get(name)
+        return content.decode('utf-8') if content is not None else None
+
+    def model_urls(self):
+        for name in sorted(self.templates):
+            parts = name.split('/')
+            if len(parts) == 3 and parts[2] == 'urls':
+                urls = self.templates[name].decode('utf-8').splitlines()
+                yield parts[0], parts[1], urls
+
+    def lookup(self, mac=''):
+        phone = self.phones.get(mac) if mac else None
+        if phone is not None:
+            phone = dict(phone, mac=mac, backend={'name': phone['backend']})
+            phone.setdefault('lines', [phone['extension']])
+        return self.settings, phone
+
+    def get_pbx_users(self, phone, stale=None):
+        pbx_users = phone.get('pbx_users') or {phone['extension']: phone.get('pbx_user')}
+        return dict((ext, tuple(user) if user else None) for ext, user in pbx_users.items())
+
+    def get_directory(self):
+        return self.directory
+
+def export_bundle(path, base_path=None):
+    """Writes a bundle of everything the provisioning path needs to path
+
+    With base_path only the phones and template files that differ from that
+    bundle are written, along with what was removed since. The base must be
+    a full bundle, and later deltas are written against the same full bundle.
+    The FreePBX connection settings are left out.
+
+    :param path Bundle file to write
+    :type path str
+    :param base_path Existing bundle to compute a delta against
+    :type base_path str
+    :return The manifest of the new bundle
+    :rtype dict
+    """
+
+    import tarfile
+    base = None
+    if base_path:
+        base = ProvisioningBundle.read(base_path)
+        if base[0]['base']:
+            raise ValueError('{} is a delta bundle, use the full bundle it is based on as the base'.format(base_path))
+    db = connect_db()
+    try:
+        s = db.execute('SELECT * FROM settings')
+        settings = dict((column, value) for column, value in zip(SETTINGS_COLUMNS, s.fetchone())
+                        if not column.startswith('mysql_'))
+        backends = get_backends(db)
+        phones = [phone_from_row(r) for r in db.execute('SELECT * FROM ext_mac_map').fetchall()]
+        lines = get_phone_lines(db, [p['mac'] for p in phones])
+    finally:
+        db.close()
+
+    by_backend = {}
+    for phone in phones:
+        phone['lines'] = [phone['extension']] + lines[phone['mac']]
+        phone['backend'] = resolve_backend(backends, phone['extension'], phone['backend'])
+        by_backend.setdefault(phone['backend']['name'], []).append(phone)
+
+    def resolve_users(backend):
+        return get_pbx_users(backend, [ext for p in by_backend[backend['name']] for ext in p['lines']])
+
+    bundle_phones = {}
+    for backend, pbx_users, error in map_backends(resolve_users, [b for b in backends if b['name'] in by_backend]):
+        if error is not None:
+            raise error
+        for phone in by_backend[backend['name']]:
+            pbx_user = pbx_users[phone['extension']]
+            bundle_phones[phone['mac']] = {
+                'extension': phone['extension'],
+                'template': phone['template'],
+                'misc': phone['misc'],
+                'backend': backend['name'],
+                'pbx_user': list(pbx_user) if pbx_user else None,
+                'lines': phone['lines'],
+                'pbx_users': dict((ext, list(pbx_users[ext]) if pbx_users[ext] else None) for ext in phone['lines']),
+            }
+
+    templates = {}
+    for root, _dirs, files in os.walk(TEMPLATES_FOLDER):
+        for fn in files:
+            full_path = os.path.join(root, fn)
+            name = os.path.relpath(full_path, TEMPLATES_FOLDER).replace(os.sep, '/')
+            with open(full_path, 'rb') as f:
+                templates[name] = f.read()
+
+    directory = get_directory()
+    directory = {'version': directory['version'], 'entries': directory['entries']}
+    data = {'settings': settings, 'phones': bundle_phones, 'directory': directory,
+            'removed_phones': [], 'removed_templates': []}
+    base_version = None
+    if base is not None:
+        base_manifest, base_data, base_templates = base
+        base_version = base_manifest['version']
+        base_phones = base_data['phones']
+        data['phones'] = dict((mac, p) for mac, p in bundle_phones.items() if base_phones.get(mac) != p)
+        data['removed_phones'] = sorted(set(base_phones) - set(bundle_phones))
+        data['removed_templates'] = sorted(set(base_templates) - set(templates))
+        templates = dict((name, content) for name, content in templates.items()
+                         if base_templates.get(name) != content)
+
+    members = {'data.json': json.dumps(data, sort_keys=True).encode('utf-8')}
+    for name, content in templates.items():
+        members['templates/' + name] = content
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': '{:.6f}'.format(time.time()),
+        'base': base_version,
+        'files': dict((name, hashlib.sha256(content).hexdigest()) for name, content in members.items()),
+    }
+    members['manifest.json'] = json.dumps(manifest, sort_keys=True).encode('utf-8')
+
+    tmp_path = path + '.tmp'
+    with tarfile.open(tmp_path, 'w:gz') as tar:
+        for name in sorted(members):
+            info = tarfile.TarInfo(name)
+            info.size = len(members[name])
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(members[name]))
+    os.rename(tmp_path, path)
+    return manifest
+
+_REPLICA = {'bundle': None, 'checked': 0, 'mtimes': {}}
+_REPLICA_LOCK = threading.Lock()
+
+def get_replica_bundle():
+    """Returns the current replica bundle, swapping in newer bundles from REPLICA_BUNDLE_DIR
+
+    The folder is scanned at most every BUNDLE_POLL_INTERVAL seconds. The newest
+    full bundle is loaded and any delta bundles chained onto it are applied.
+    Requests already holding the old bundle finish with it, and while one
+    thread loads, the others keep serving the old bundle.
+    """
+
+    import tarfile
+    bundle = _REPLICA['bundle']
+    now = time.time()
+    if bundle is not None and now - _REPLICA['checked'] < BUNDLE_POLL_INTERVAL:
+        return bundle
+    if not _REPLICA_LOCK.acquire(False):
+        if bundle is not None:
+            return bundle
+        _REPLICA_LOCK.acquire()
+    try:
+        if _REPLICA['bundle'] is not bundle:
+            return _REPLICA['bundle']
+        _REPLICA['checked'] = now
+        try:
+            names = [fn for fn in os.listdir(REPLICA_BUNDLE_DIR) if fn.endswith('.bundle')]
+        except OSError as e:
+            print(e)
+            return bundle
+        mtimes = dict((fn, os.path.getmtime(os.path.join(REPLICA_BUNDLE_DIR, fn))) for fn in names)
+        if mtimes == _REPLICA['mtimes']:
+            return bundle
+        try:
+            new_bundle = load_bundle_chain([os.path.join(REPLICA_BUNDLE_DIR, fn) for fn in names])
+        except (IOError, ValueError, KeyError, tarfile.TarError) as e:
+            print(e)
+            return bundle
+        _REPLICA['mtimes'] = mtimes
+        if new_bundle is not None:
+            _REPLICA['bundle'] = new_bundle
+        return _REPLICA['bundle']
+    finally:
+        _REPLICA_LOCK.release()
+
+def load_bundle_chain(paths):
+    """Loads the newest full bundle in paths with its chain of delta bundles applied"""
+
+    import tarfile
+    manifests = []
+    for path in paths:
+        with tarfile.open(path, 'r:gz') as tar:
+            manifests.append((json.loads(tar.extractfile('manifest.json').read().decode('utf-8')), path))
+    full = [(m['version'], path) for m, path in manifests if not m['base']]
+    if not full:
+        return None
+    bundle = ProvisioningBundle.load(max(full)[1])
+    manifests.sort(key=lambda m_path: m_path[0]['version'])
+    deltas = dict((m['base'], path) for m, path in manifests if m['base'])
+    while bundle.version in deltas:
+        bundle = bundle.apply_delta(deltas[bundle.version])
+    return bundle
+
+def get_provisioning_source():
+    return LOCAL_SOURCE
+
+def replica_application(environ, start_response):
+    """WSGI entry point for read-only replicas serving only from bundles"""
+
+    response = check_health(environ, get_replica_bundle)
+    if response is not None:
+        return send_response(response, start_response, environ)
+    wait_for_warm_up(get_replica_bundle)
+    bundle = get_replica_bundle()
+    if bundle is None:
+        response = AppResponse('{}<h1>No provisioning bundle loaded!</h1>'.format(get_def_head()), STATUS['ISE'])
+    else:
+        response = process_provisioning_request(environ, bundle)
+    return send_response(response, start_response, environ)
+
+TFTP_RRQ, TFTP_WRQ, TFTP_DATA, TFTP_ACK, TFTP_ERROR, TFTP_OACK = 1, 2, 3, 4, 5, 6
+
+def tftp_error(code, message):
+    return struct.pack('!HH', TFTP_ERROR, code) + message.encode('ascii') + b'\0'
+
+def resolve_tftp_file(filename, remote_addr, source=None):
+    """Resolves a TFTP filename through the same routing as HTTP requests
+
+    :return The file contents or None if nothing serves that filename
+    :rtype bytes
+    """
+
+    path = '/' + filename.replace('\\', '/').lstrip('/')
+    if '..' in path.split('/'):
+        return None
+    environ = {
+        'PATH_INFO': path,
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'REMOTE_ADDR': remote_addr,
+        'SERVER_PROTOCOL': 'TFTP',
+    }
+    response = process_provisioning_request(environ, source)
+    if response.get_status() != STATUS['OK']:
+        return None
+    return b''.join(response.iter_body())
+
+class TFTPTransfer(object):
+    """asyncio datagram protocol sending one file from its own ephemeral port"""
+
+    def __init__(self, loop, addr, data, blksize, oack):
+        self.loop = loop
+        self.addr = addr
+        self.data = data
+        self.blksize = blksize
+        self.oack = oack
+        self.block = 0 if oack else 1
+        self.retries = 0
+        self.timer = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send_current()
+
+    def packet(self):
+        if self.block == 0:
+            return self.oack
+        start = (self.block - 1) * self.blksize
+        return struct.pack('!HH', TFTP_DATA, self.block % 65536) + self.data[start:start + self.blksize]
+
+    def send_current(self):
+        self.transport.sendto(self.packet(), self.addr)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(TFTP_TIMEOUT, self.timeout)
+
+    def timeout(self):
+        self.retries += 1
+        if self.retries > TFTP_RETRIES:
+            self.transport.close()
+        else:
+            self.send_current()
+
+    def datagram_received(self, packet, addr):
+        if addr != self.addr:
+            # Never answer an error with an error (RFC 1350)
+            if packet[:2] != struct.pack('!H', TFTP_ERROR):
+                self.transport.sendto(tftp_error(5, 'Unknown transfer ID'), addr)
+            return
+        if len(packet) < 4:
+            return
+        opcode, block = struct.unpack('!HH', packet[:4])
+        if opcode == TFTP_ERROR:
+            self.transport.close()
+        elif opcode == TFTP_ACK and block == self.block % 65536:
+            if self.block > 0 and (self.block - 1) * self.blksize + self.blksize > len(self.data):
+                self.transport.close()
+                return
+            self.block += 1
+            self.retries = 0
+            self.send_current()
+
+    def error_received(self, exc):
+        print(exc)
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+
+class TFTPServer(object):
+    """asyncio datagram protocol answering TFTP read requests (RFC 1350, 2347-2349)
+
+    Filenames are resolved in the executor with resolve_tftp_file, and each
+    transfer then runs as a TFTPTransfer on its own port. Write requests are
+    refused.
+    """
+
+    def __init__(self, loop, host, source=None):
+        self.loop = loop
+        self.host = host
+        self.source = source
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, packet, addr):
+        opcode = struct.unpack('!H', packet[:2])[0] if len(packet) >= 2 else 0
+        if opcode == TFTP_WRQ:
+            self.transport.sendto(tftp_error(2, 'Read only server'), addr)
+            return
+        if opcode in (TFTP_ACK, TFTP_ERROR):
+            # Strays from finished or abandoned transfers, never answered (RFC 1350)
+            return
+        if opcode != TFTP_RRQ:
+            self.transport.sendto(tftp_error(4, 'Illegal TFTP operation'), addr)
+            return
+        fields = packet[2:].split(b'\0')
+        if len(fields) < 3:
+            self.transport.sendto(tftp_error(4, 'Malformed request'), addr)
+            return
+        filename = fields[0].decode('ascii', 'replace')
+        mode = fields[1].decode('ascii', 'replace').lower()
+        options = dict((k.decode('ascii', 'replace').lower(), v.decode('ascii', 'replace'))
+                       for k, v in zip(fields[2:-1:2], fields[3:-1:2]))
+        future = self.loop.run_in_executor(None, self.resolve, filename, addr[0])
+        future.add_done_callback(lambda f: self.start_transfer(f, addr, mode, options))
+
+    def resolve(self, filename, remote_addr):
+        # Runs in the executor, since getting a replica bundle reads the disk
+        source = self.source() if callable(self.source) else self.source
+        return resolve_tftp_file(filename, remote_addr, source)
+
+    def start_transfer(self, future, addr, mode, options):
+        try:
+            data = future.result()
+        except Exception as e:
+            print(e)
+            data = None
+        if data is None:
+            self.transport.sendto(tftp_error(1, 'File not found'), addr)
+            return
+        if mode == 'netascii':
+            data = data.replace(b'\r', b'\r\0').replace(b'\n', b'\r\n')
+
+        blksize = TFTP_BLKSIZE
+        reply = []
+        if 'blksize' in options:
+            try:
+                blksize = max(8, min(int(options['blksize']), TFTP_MAX_BLKSIZE))
+                reply.append(('blksize', str(blksize)))
+            except ValueError:
+                blksize = TFTP_BLKSIZE
+        if 'tsize' in options:
+            reply.append(('tsize', str(len(data))))
+        oack = None
+        if reply:
+            oack = struct.pack('!H', TFTP_OACK) + b''.join(k.encode('ascii') + b'\0' + v.encode('ascii') + b'\0' for k, v in reply)
+
+        self.loop.create_task(self.loop.create_datagram_endpoint(
+            lambda: TFTPTransfer(self.loop, addr, data, blksize, oack), local_addr=(self.host, 0)))
+
+    def error_received(self, exc):
+        print(exc)
+
+    def connection_lost(self, exc):
+        pass
+
+def serve_tftp(host='0.0.0.0', port=69, source=None):
+    """Runs the TFTP server forever
+
+    :param source Provisioning source, or a callable returning one per request
+    """
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(TFTP_RENDER_THREADS))
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: TFTPServer(loop, host, source), local_addr=(host, port)))
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+
+def tftp_get(host, port, filename, blksize=None, timeout=TFTP_TIMEOUT):
+    """Downloads a file in octet mode, as a minimal client for testing the TFTP server
+
+    :param blksize Block size to ask for with the blksize option, or None for 512
+    :return The file contents
+    :rtype bytes
+    :raises IOError with the server's message when it answers with an error,
+        or after TFTP_RETRIES timeouts
+    """
+
+    request = struct.pack('!H', TFTP_RRQ) + filename.encode('ascii') + b'\0octet\0'
+    if blksize:
+        request += b'blksize\0' + str(blksize).encode('ascii') + b'\0tsize\0' + b'0\0'
+    size = TFTP_BLKSIZE
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        last, peer = request, (host, port)
+        block, data, retries = 1, [], 0
+        while True:
+            sock.sendto(last, peer)
+            try:
+                packet, addr = sock.recvfrom(65536)
+            except socket.timeout:
+                retries += 1
+                if retries > TFTP_RETRIES:
+                    raise IOError('Timed out waiting for block {}'.format(block))
+                continue
+            retries = 0
+            if peer == (host, port) and last is request:
+                peer = addr
+            opcode = struct.unpack('!H', packet[:2])[0]
+            if opcode == TFTP_ERROR:
+                raise IOError(packet[4:].rstrip(b'\0').decode('ascii', 'replace'))
+            if opcode == TFTP_OACK:
+                fields = packet[2:].split(b'\0')
+                options = dict(zip(fields[0:-1:2], fields[1:-1:2]))
+                size = int(options.get(b'blksize', size))
+                last = struct.pack('!HH', TFTP_ACK, 0)
+            elif opcode == TFTP_DATA and struct.unpack('!H', packet[2:4])[0] == block % 65536:
+                data.append(packet[4:])
+                last = struct.pack('!HH', TFTP_ACK, block % 65536)
+                if len(packet) - 4 < size:
+                    sock.sendto(last, peer)
+                    return b''.join(data)
+                block += 1
+    finally:
+        sock.close()
+
+def hash_pw(pw):
+    salt = os.urandom(SALT_LEN)
+    key = pbkdf2_hmac('sha256', pw.encode('utf-8'), salt, 100000)
+    return salt + key
+
+def compare_hash(candidate, hashed_pw):
+    salt, key = hashed_pw[:SALT_LEN], hashed_pw[SALT_LEN:]
+    cand_key = pbkdf2_hmac('sha256', candidate.encode('utf-8'), salt, 100000)
+    return cand_key == key
+    
+def process_request(environ):
+    path_info = environ.get('PATH_INFO', '')
+
+    if path_info == '/' or path_info == '':
+        return get_index(environ)
+
+    elif path_info == '/submit-setup':
+        return submit_setup(environ)
+
+    elif path_info == '/admin' or path_info == '/admin/':
+        return get_admin(environ)
+
+    elif path_info == '/global-settings':
+        return get_global_settings(environ)
+
+    elif path_info == '/model-globals':
+        return get_model_globals(environ)
+
+    elif path_info == '/phone-list':
+        return get_phone_list(environ)
+
+    elif path_info == '/edit-phone':
+        return edit_phone(environ)
+
+    elif path_info == '/pbx-backends':
+        return get_pbx_backends(environ)
+
+    elif path_info == '/bulk-edit':
+        return get_bulk_edit(environ)
+
+    elif path_info == '/jobs':
+        return get_jobs_page(environ)
+
+    elif path_info == '/resync':
+        return get_resync(environ)
+
+    elif path_info == '/account':
+        return get_account(environ)
+
+    elif path_info == '/logout':
+        return get_logout(environ)
+
+    elif path_info.startswith('/api/v1/'):
+        return api_request(environ)
+
+    else:
+        return process_provisioning_request(environ)
+
+@contextmanager
+def server_timing(environ, name):
+    """Adds the time spent in the block to the request's Server-Timing entry name
+
+    Steps are lookup (settings and phone row), backend (FreePBX credentials
+    or the directory) and render.
+    """
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        timings = environ.setdefault('prov.timings', OrderedDict())
+        timings[name] = timings.get(name, 0) + time.time() - started
+
+def process_provisioning_request(environ, source=None):
+    """Serves phone configs, phonebooks and static files, and nothing else
+
+    Clients whose requests keep missing get 429 instead of 404 for further
+    misses, throttled with MISS_BUCKETS. Requests for files that exist are
+    always served, so phones behind the same NAT as a scanner keep working.
+    """
+
+    environ.setdefault('prov.started', time.time())
+    path_info = environ.get('PATH_INFO', '')
+    if path_info.startswith('/phonebook/') and path_info.count('/') == 3:
+        _empty, _phonebook, brand, model = path_info.split('/')
+        return render_phonebook(environ, brand, model, 'xml', source)
+
+    cbu_ret = check_brand_urls(environ, source)
+    if cbu_ret:
+        return cbu_ret
+
+    csc_ret = check_static_content(environ, source)
+    if csc_ret:
+        return csc_ret
+
+    client = environ.get('REMOTE_ADDR', '')
+    if not MISS_BUCKETS.allowed(client):
+        return AppResponse('Too many requests for unknown files', STATUS['Too Many Requests'],
+                           [ HEADER['plain'], ('Retry-After', str(int(1 / MISS_RATE) + 1)) ])
+    MISS_BUCKETS.consume(client)
+    return AppResponse('{}<h1>404 File Not Found!</h1>'.format(get_def_head()), STATUS['Not Found'])
+
+def send_response(response, start_response, environ=None):
+    """Starts the response and returns its body as a WSGI iterable
+
+    Content-Length is added whenever the body length is known, otherwise
+    the server sends the body chunked. File bodies go through the server's
+    wsgi.file_wrapper when environ offers one. Phone requests get a
+    Server-Timing header with the steps timed by server_timing and the total.
+    """
+
+    header = list(response.get_header())
+    length = response.content_length()
+    if length is not None and not any(name.lower() == 'content-length' for name, _value in header):
+        header.append(('Content-Length', str(length)))
+    if environ is not None and 'prov.started' in environ:
+        timings = list(environ.get('prov.timings', {}).items())
+        timings.append(('total', time.time() - environ['prov.started']))
+        header.append(('Server-Timing', ', '.join('{};dur={:.3f}'.format(name, seconds * 1000) for name, seconds in timings)))
+    start_response(response.get_status(), header)
+
+    body = response.get_html()
+    if isinstance(body, TEXT_TYPES):
+        return [to_bytes(body)]
+    if hasattr(body, 'read') and environ is not None and 'wsgi.file_wrapper' in environ:
+        return environ['wsgi.file_wrapper'](body, STREAM_CHUNK_SIZE)
+    return response.iter_body()
+
+_WARMUP = {'state': 'pending', 'started': None, 'finished': None, 'steps': {}, 'errors': {}}
+_WARMUP_LOCK = threading.Lock()
+_WARMUP_DONE = threading.Event()
+
+def warm_pool(backend):
+    with get_pool(backend).connection():
+        pass
+
+def warm_up(source):
+    """Loads what the first phone requests would otherwise pay for
+
+    Scans the routes, reads the settings, compiles every template the urls
+    files route to along with what it includes and opens a connection to
+    each PBX backend. Steps that fail are reported by
+    /readyz, and only failing to read the settings leaves the process unready.
+
+    :return Tuple of (whether the process is ready, step timings, step errors)
+    :rtype tuple
+    """
+
+    steps, errors = {}, {}
+
+    def step(name, func):
+        started = time.time()
+        try:
+            steps[name] = {'count': func()}
+        except Exception as e:
+            print(e)
+            errors[name] = str(e)
+            return False
+        steps[name]['elapsed'] = round(time.time() - started, 3)
+        return True
+
+    if source is None:
+        errors['source'] = 'No provisioning bundle loaded'
+        return False, steps, errors
+
+    def templates():
+        names = set()
+        for brand, model, urls in source.model_urls():
+            for url in urls:
+                m = re.search(RE_COMMENT_PATTERN, url)
+                if m:
+                    names.update(template_dependencies(source.template_env, os.path.join(brand, model, m.group('templatefile')))[1])
+        names.discard('*')
+        for name in names:
+            source.template_env.get_template(name)
+        return len(names)
+
+    def pbx():
+        db = connect_db()
+        try:
+            backends = get_backends(db)
+        finally:
+            db.close()
+        for backend, _result, e in map_backends(warm_pool, backends):
+            if e is not None:
+                print(e)
+                errors[' '.join(('pbx', backend['name'])).strip()] = str(e)
+        return len(backends)
+
+    step('routes', lambda: len(source.model_urls()))
+    ready = step('settings', lambda: len(source.lookup()[0]))
+    step('templates', templates)
+    if isinstance(source, LocalSource):
+        step('pbx', pbx)
+    return ready, steps, errors
+
+def start_warm_up(source_getter=get_provisioning_source, wait=False):
+    """Runs warm_up once per process, in a background thread unless wait is set
+
+    A warm-up that failed is started again.
+    """
+
+    with _WARMUP_LOCK:
+        if _WARMUP['state'] not in ('pending', 'failed'):
+            return
+        if not WARMUP:
+            _WARMUP['state'] = 'ready'
+            _WARMUP_DONE.set()
+            return
+        _WARMUP_DONE.clear()
+        _WARMUP.update(state='warming', started=time.time(), finished=None, steps={}, errors={})
+
+    def run():
+        try:
+            ready, steps, errors = warm_up(source_getter())
+        except Exception as e:
+            print(e)
+            ready, steps, errors = False, {}, {'warm-up': str(e)}
+        _WARMUP.update(steps=steps, errors=errors, finished=time.time())
+        _WARMUP['state'] = 'ready' if ready else 'failed'
+        _WARMUP_DONE.set()
+
+    if wait:
+        run()
+    else:
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+def wait_for_warm_up(source_getter=get_provisioning_source):
+    """Holds a request until this process has warmed up, for up to WARMUP_TIMEOUT seconds
+
+    Called by every WSGI entry point before serving anything but health
+    checks, so under Apache the first requests wait for the warm-up instead
+    of racing it.
+    """
+
+    start_warm_up(source_getter)
+    _WARMUP_DONE.wait(WARMUP_TIMEOUT)
+
+def check_health(environ, source_getter=get_provisioning_source):
+    """Answers /healthz and /readyz from memory, or returns None for other paths
+
+    /healthz only shows that the process answers. /readyz is 503 until the
+    warm-up has finished.
+    """
+
+    path_info = environ.get('PATH_INFO', '')
+    if path_info == '/healthz':
+        return AppResponse('ok\n', STATUS['OK'], [ HEADER['plain'], ('Cache-Control', 'no-store') ])
+    if path_info != '/readyz':
+        return None
+    start_warm_up(source_getter)
+    state = _WARMUP['state']
+    data = {'state': state, 'steps': _WARMUP['steps'], 'errors': _WARMUP['errors'],
+            'caches': {'render': RENDER_CACHE.stats(), 'fragments': FRAGMENT_CACHE.stats()}}
+    if _WARMUP['finished']:
+        data['warm_up_seconds'] = round(_WARMUP['finished'] - _WARMUP['started'], 3)
+    header = [ HEADER['json'], ('Cache-Control', 'no-store') ]
+    if state != 'ready':
+        return AppResponse(json.dumps(data, sort_keys=True), STATUS['Service Unavailable'], header + [ ('Retry-After', '1') ])
+    return AppResponse(json.dumps(data, sort_keys=True), STATUS['OK'], header)
+
+def base_application(environ, start_response):
+    response = process_request(environ)
+    return send_response(response, start_response, environ)
 
 session_opts = {
     'session.type': 'file',
@@ -1202,10 +4558,481 @@ session_opts = {
     'session.key': 'prov.session.id',
 }
 
-application = SessionMiddleware(application, session_opts)
+_SESSION_APPLICATION = []
+
+def application(environ, start_response):
+    """WSGI entry point for phones and the admin pages
+
+    Beaker is imported and wrapped around base_application on the first
+    request, which also starts this process's job runner.
+    """
+
+    health = check_health(environ)
+    if health is not None:
+        return send_response(health, start_response, environ)
+    wait_for_warm_up()
+    if not _SESSION_APPLICATION:
+        from beaker.middleware import SessionMiddleware
+        _SESSION_APPLICATION.append(SessionMiddleware(base_application, session_opts))
+        start_job_runner()
+    return _SESSION_APPLICATION[0](environ, start_response)
+
+def provisioning_application(environ, start_response):
+    """Lean WSGI entry point for workers that only serve phones
+
+    Skips the admin pages and beaker sessions entirely, so beaker is never
+    imported and the MySQL driver is only loaded for the first phone config.
+    """
+
+    response = check_health(environ)
+    if response is None:
+        wait_for_warm_up()
+        response = process_provisioning_request(environ)
+    return send_response(response, start_response, environ)
+
+def clear_caches():
+    """Drops every in-process cache so settings and templates are read again"""
+
+    LOCAL_SOURCE.routes = None
+    TEMPLATE_ENV.cache.clear()
+    with _CREDENTIAL_LOCK:
+        _CREDENTIAL_CACHE.clear()
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close_all()
+    _DIRECTORY['snapshot'] = None
+    UNKNOWN_MACS.clear()
+    MISSING_STATIC.clear()
+    _REPLICA['mtimes'] = {}
+    _REPLICA['checked'] = 0
+    RENDER_CACHE.clear()
+    FRAGMENT_CACHE.clear()
+    _TEMPLATE_DEPS.clear()
+    _OUTPUT_DEPS.clear()
+    with _WARMUP_LOCK:
+        if _WARMUP['state'] != 'warming':
+            _WARMUP['state'] = 'pending'
+
+class SnapshotSource(object):
+    """Provisioning inputs frozen for rendering outside of a running worker
+
+    Templates come from templates_folder. FreePBX users and the directory
+    come from a snapshot, or are made up from the extensions when pbx is None.
+    """
+
+    version = None
+
+    def __init__(self, templates_folder, settings, pbx=None, directory=None):
+        self.templates_folder = templates_folder
+        self.template_env = Environment(loader=FileSystemLoader(templates_folder), extensions=[FragmentCacheExtension])
+        self.template_env.fragment_cache_version = templates_folder
+        self.settings = settings
+        self.pbx = pbx
+        self.directory = directory or {'version': None, 'entries': []}
+
+    def model_urls(self):
+        return list(LocalSource(self.templates_folder, self.template_env).scan_model_urls())
+
+    def lookup(self, mac=''):
+        return self.settings, None
+
+    def get_pbx_users(self, phone, stale=None):
+        if self.pbx is None:
+            return dict((ext, ('secret' + ext, 'Extension ' + ext)) for ext in phone['lines'])
+        users = self.pbx.get(phone['backend']['name'], {})
+        return dict((ext, tuple(users[ext]) if users.get(ext) else None) for ext in phone['lines'])
+
+    def get_directory(self):
+        return self.directory
+
+_ANALYZER = {}
+
+def init_analyzer(templates_folder, settings, pbx, directory):
+    _ANALYZER['source'] = SnapshotSource(templates_folder, settings, pbx, directory)
+
+def analyze_render(task):
+    """Renders one output in a pool process
+
+    Templates are compiled before the clock starts, so only rendering is
+    timed. FRAGMENT_CACHE is emptied first, so {% cache %} blocks are
+    rendered cold, just as for the first phone after a change.
+
+    :param task Tuple of (template path, request path, format, phone or None)
+    :return Tuple of (template path, mac, seconds, output bytes, error or None).
+        The bytes are None for phones Prov would answer with 404 because
+        their extension has no secret.
+    :rtype tuple
+    """
+
+    template_path, path, _fmt, phone = task
+    source = _ANALYZER['source']
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', 'REMOTE_ADDR': '127.0.0.1'}
+    mac = phone['mac'] if phone else ''
+    started = time.time()
+    try:
+        template = source.template_env.get_template(template_path)
+        brand, model, templatefile = template_path.split('/', 2)
+        if templatefile == PHONEBOOK_TEMPLATE:
+            context = phonebook_context(environ, source.settings, source.directory, brand, model)
+        else:
+            pbx_users = source.get_pbx_users(phone) if phone else None
+            if phone and not pbx_users.get(phone['extension']):
+                return template_path, mac, 0, None, None
+            context = template_context(environ, source, source.settings, phone, pbx_users)
+        FRAGMENT_CACHE.clear()
+        started = time.time()
+        size = len(to_bytes(template.render(**context)))
+    except Exception as e:
+        return template_path, mac, time.time() - started, 0, '{}: {}'.format(type(e).__name__, e)
+    return template_path, mac, time.time() - started, size, None
+
+def analysis_tasks(source, phones):
+    """Lists every (template, phone) pair reachable through the urls files
+
+    Files without a mac group are rendered once per model, files with one
+    once per phone of that model.
+    """
+
+    import prov_storm
+    by_model = {}
+    for phone in phones:
+        by_model.setdefault(phone['template'], []).append(phone)
+    tasks = []
+    for brand, model, urls in source.model_urls():
+        for url in urls:
+            m = re.search(RE_COMMENT_PATTERN, url)
+            if not m:
+                continue
+            template_path = '/'.join((brand, model, m.group('templatefile')))
+            if '(?P<mac>' not in url:
+                tasks.append((template_path, prov_storm.url_path(url) or '', m.group('format'), None))
+                continue
+            for phone in by_model.get('{}/{}'.format(brand, model), ()):
+                tasks.append((template_path, prov_storm.url_path(url, phone['mac']) or '', m.group('format'), phone))
+    return tasks
+
+def analyze_templates(templates_folder, settings, phones, pbx=None, directory=None, processes=None):
+    """Renders every reachable output of a templates folder across a process pool
+
+    :return Dict of 'templates', {template path: stats}, 'slowest', the
+        slowest (seconds, template path, mac) renders, 'renders' and 'seconds'
+    :rtype dict
+    """
+
+    import multiprocessing
+    source = SnapshotSource(templates_folder, settings, pbx, directory)
+    tasks = analysis_tasks(source, phones)
+    templates = {}
+    slowest = []
+    started = time.time()
+    pool = multiprocessing.Pool(processes, init_analyzer, (templates_folder, settings, pbx, directory))
+    try:
+        for template_path, mac, elapsed, size, error in pool.imap_unordered(analyze_render, tasks, 16):
+            t = templates.setdefault(template_path, {'renders': 0, 'errors': 0, 'skipped': 0, 'times': [], 'bytes': 0,
+                                                     'error_counts': {}})
+            if size is None and error is None:
+                t['skipped'] += 1
+                continue
+            t['renders'] += 1
+            if error is not None:
+                t['errors'] += 1
+                t['error_counts'][error] = t['error_counts'].get(error, 0) + 1
+                continue
+            t['times'].append(elapsed)
+            t['bytes'] += size
+            slowest.append((elapsed, template_path, mac))
+    finally:
+        pool.close()
+        pool.join()
+    for t in templates.values():
+        times = sorted(t.pop('times'))
+        t['total'] = sum(times)
+        t['mean'] = t['total'] / len(times) if times else 0
+        t['p95'] = times[min(len(times) - 1, int(len(times) * 0.95))] if times else 0
+        t['max'] = times[-1] if times else 0
+        t['mean_bytes'] = t['bytes'] // len(times) if times else 0
+    slowest.sort(reverse=True)
+    return {'templates': templates, 'slowest': slowest[:20], 'renders': len(tasks), 'seconds': time.time() - started}
+
+def format_analysis(result, top=None):
+    ms = lambda seconds: '{:.2f}ms'.format(seconds * 1000)
+    templates = sorted(result['templates'].items(), key=lambda item: item[1]['total'], reverse=True)[:top]
+    lines = ['{:<40} {:>7} {:>6} {:>7} {:>11} {:>10} {:>10} {:>10} {:>9}'.format(
+        'template', 'renders', 'errors', 'skipped', 'total', 'mean', 'p95', 'max', 'avg size')]
+    for name, t in templates:
+        lines.append('{:<40} {:>7} {:>6} {:>7} {:>11} {:>10} {:>10} {:>10} {:>9}'.format(
+            name, t['renders'], t['errors'], t['skipped'], ms(t['total']), ms(t['mean']), ms(t['p95']), ms(t['max']),
+            t['mean_bytes']))
+    if result['slowest']:
+        lines += ['', 'Slowest renders:']
+        lines += ['  {:>10} {} {}'.format(ms(elapsed), name, mac) for elapsed, name, mac in result['slowest'][:top or 10]]
+    errors = [(count, name, error) for name, t in templates for error, count in t['error_counts'].items()]
+    if errors:
+        lines += ['', 'Errors:']
+        lines += ['  {:>5} x {}: {}'.format(count, name, error) for count, name, error in sorted(errors, reverse=True)]
+    return '\n'.join(lines)
+
+def comparison_change(a, b):
+    """Describes how a template file's renders changed between two analyses
+
+    Means only cover successful renders, so files that stopped rendering
+    at all are reported as broken rather than as faster.
+    """
+
+    a_ok, b_ok = a['renders'] - a['errors'], b['renders'] - b['errors']
+    if not a['renders']:
+        return 'new'
+    if not b['renders']:
+        return 'gone'
+    if a_ok and not b_ok:
+        return 'broken'
+    if b_ok and not a_ok:
+        return 'fixed'
+    if not a_ok or not a['mean']:
+        return '-'
+    return '{:+.0%}'.format(b['mean'] / a['mean'] - 1)
+
+def format_comparison(base, other, top=None):
+    ms = lambda seconds: '{:.2f}ms'.format(seconds * 1000)
+    empty = {'renders': 0, 'errors': 0, 'total': 0, 'mean': 0, 'mean_bytes': 0}
+    names = set(base['templates']) | set(other['templates'])
+    rows = [(name, base['templates'].get(name, empty), other['templates'].get(name, empty)) for name in names]
+    rows = [(comparison_change(a, b), name, a, b) for name, a, b in rows]
+    rows.sort(key=lambda row: (row[0] != 'broken', row[2]['total'] - row[3]['total']))
+    lines = ['{:<40} {:>7} {:>10} {:>10} {:>8} {:>9} {:>9} {:>8}'.format(
+        'template', 'renders', 'mean A', 'mean B', 'change', 'size A', 'size B', 'errors')]
+    for change, name, a, b in rows[:top]:
+        lines.append('{:<40} {:>7} {:>10} {:>10} {:>8} {:>9} {:>9} {:>8}'.format(
+            name, max(a['renders'], b['renders']), ms(a['mean']), ms(b['mean']), change,
+            a['mean_bytes'], b['mean_bytes'], '{}/{}'.format(a['errors'], b['errors'])))
+    lines.append('')
+    lines.append('Total render time: {} -> {}'.format(ms(sum(t['total'] for t in base['templates'].values())),
+                                                     ms(sum(t['total'] for t in other['templates'].values()))))
+    return '\n'.join(lines)
+
+def pbx_snapshot(phones):
+    """Reads the FreePBX users of every phone line and the directory
+
+    :return Tuple of ({backend name: {extension: [secret, name]}}, directory snapshot)
+    :rtype tuple
+    """
+
+    by_backend = {}
+    for phone in phones:
+        backend, exts = by_backend.setdefault(phone['backend']['name'], (phone['backend'], set()))
+        exts.update(phone['lines'])
+    pbx = {}
+    for name, (backend, exts) in by_backend.items():
+        users = get_pbx_users(backend, sorted(exts))
+        pbx[name] = dict((ext, list(user)) for ext, user in users.items() if user)
+    directory = get_directory()
+    return pbx, {'version': directory['version'], 'entries': directory['entries']}
+
+def analyze_renders(args):
+    """Reports render cost per template file for the phone list, or compares two template folders"""
+
+    db = connect_db()
+    try:
+        settings = dict(zip(SETTINGS_COLUMNS, db.execute('SELECT * FROM settings').fetchone()))
+        backends = get_backends(db)
+        phones = [phone_from_row(r) for r in db.execute('SELECT * FROM ext_mac_map ORDER BY rowid')]
+        lines = get_phone_lines(db, [phone['mac'] for phone in phones])
+    finally:
+        db.close()
+    for phone in phones:
+        phone['backend'] = resolve_backend(backends, phone['extension'], phone['backend'])
+        phone['lines'] = [phone['extension']] + lines[phone['mac']]
+
+    pbx, directory = None, None
+    if args.pbx_snapshot:
+        with open(args.pbx_snapshot) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        pbx, directory = snapshot['users'], snapshot['directory']
+    elif args.live_pbx:
+        pbx, directory = pbx_snapshot(phones)
+        if args.save_pbx_snapshot:
+            with open(args.save_pbx_snapshot, 'w') as snapshot_file:
+                json.dump({'users': pbx, 'directory': directory}, snapshot_file)
+    if directory is None:
+        directory = {'version': None, 'entries': sorted(
+            [{'extension': p['extension'], 'name': 'Extension ' + p['extension'], 'backend': p['backend']['name']}
+             for p in phones], key=extension_sort_key)}
+    # Backends carry database passwords, which pool processes do not need
+    for phone in phones:
+        phone['backend'] = {'name': phone['backend']['name']}
+
+    base = analyze_templates(args.templates, settings, phones, pbx, directory, args.processes)
+    if not args.compare:
+        if args.json:
+            print(json.dumps(base, indent=2, sort_keys=True))
+            return
+        print('Rendered {} outputs of {} in {:.1f}s, phones without a secret are skipped'.format(
+            base['renders'], args.templates, base['seconds']))
+        print(format_analysis(base, args.top))
+        return
+    other = analyze_templates(args.compare, settings, phones, pbx, directory, args.processes)
+    if args.json:
+        print(json.dumps({'base': base, 'compare': other}, indent=2, sort_keys=True))
+        return
+    print('A: {} ({} outputs)\nB: {} ({} outputs)\n'.format(args.templates, base['renders'], args.compare, other['renders']))
+    print(format_comparison(base, other, args.top))
+
+def simulate_storm(args):
+    """Replays boot fetch sequences for the phone list and prints the report"""
+
+    import prov_storm
+    db = connect_db()
+    try:
+        phones = [phone_from_row(r) for r in db.execute('SELECT * FROM ext_mac_map ORDER BY rowid')]
+    finally:
+        db.close()
+    sequences = prov_storm.model_sequences(
+        LOCAL_SOURCE.model_urls(), RE_COMMENT_PATTERN, PHONEBOOK_TEMPLATE,
+        lambda brand, model: os.path.exists(os.path.join(TEMPLATES_FOLDER, brand, model, PHONEBOOK_TEMPLATE)),
+        args.firmware)
+    booting = [(phone, prov_storm.phone_sequence(sequences, phone)) for phone in phones]
+    booting = [b for b in booting if b[1]]
+    if not booting:
+        print('No phone has a template with fetchable urls')
+        return
+    count = args.phones or len(booting)
+    booting = [booting[i % len(booting)] for i in range(count)]
+    arrivals = prov_storm.arrival_times(count, args.curve, args.window, args.batch, args.interval, args.seed)
+
+    if args.url:
+        client_factory = lambda i: prov_storm.HTTPClient(args.url)
+    else:
+        app = application if args.app == 'full' else provisioning_application
+        client_factory = lambda i: prov_storm.WSGIClient(app, '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        # Virtual phones must not show up as real fetches on the phone list
+        _FETCHES['enabled'] = False
+    try:
+        result = prov_storm.run_storm(booting, arrivals, client_factory, args.concurrency, args.retries)
+    finally:
+        _FETCHES['enabled'] = True
+    summary = result.summary()
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print('{} phones, {} curve over {}s'.format(count, args.curve, args.window))
+        print(prov_storm.format_summary(summary))
+
+def main(argv=None):
+    global REPLICA_BUNDLE_DIR, WARMUP
+    import argparse
+    parser = argparse.ArgumentParser(description=APP_TITLE)
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='Run the built-in web server (default)')
+    serve_parser.add_argument('--bind', default='localhost:8080', help='host:port to listen on (default localhost:8080)')
+    serve_parser.add_argument('--threads', type=int, default=16, help='Worker threads per process')
+    serve_parser.add_argument('--workers', type=int, default=1, help='Processes sharing the listening socket (POSIX only)')
+    serve_parser.add_argument('--timeout', type=int, default=30, help='Seconds before an unresponsive client is dropped')
+    serve_parser.add_argument('--app', choices=('full', 'provisioning', 'replica'), default='full',
+                              help='full: phones and admin pages; provisioning: phones only; replica: phones from bundles only')
+    serve_parser.add_argument('--bundle-dir', default=REPLICA_BUNDLE_DIR)
+    serve_parser.add_argument('--no-warmup', action='store_true', help='Accept requests without warming up first')
+    tftp_parser = subparsers.add_parser('tftp', help='Run the TFTP provisioning server')
+    tftp_parser.add_argument('--host', default='0.0.0.0')
+    tftp_parser.add_argument('--port', type=int, default=69)
+    tftp_parser.add_argument('--replica', action='store_true', help='Serve from REPLICA_BUNDLE_DIR like serve --app replica')
+    tftp_parser.add_argument('--bundle-dir', default=REPLICA_BUNDLE_DIR)
+    tftp_get_parser = subparsers.add_parser('tftp-get', help='Download a file from a TFTP server, for testing')
+    tftp_get_parser.add_argument('filename')
+    tftp_get_parser.add_argument('--host', default='127.0.0.1')
+    tftp_get_parser.add_argument('--port', type=int, default=69)
+    tftp_get_parser.add_argument('--blksize', type=int, help='Ask for this block size with the blksize option')
+    tftp_get_parser.add_argument('--output', help='File to write (default: standard output)')
+    export_parser = subparsers.add_parser('export-bundle', help='Write a provisioning bundle for replicas')
+    export_parser.add_argument('path', help='Bundle file to write, conventionally ending in .bundle')
+    export_parser.add_argument('--base', help='Write a delta against this earlier bundle')
+    jobs_parser = subparsers.add_parser('jobs', help='Run background jobs without serving requests')
+    jobs_parser.add_argument('--threads', type=int, default=JOB_THREADS)
+    storm_parser = subparsers.add_parser('storm', help='Simulate many phones booting at once')
+    storm_parser.add_argument('--phones', type=int, help='Virtual phones, reusing the phone list as needed (default: one per phone)')
+    storm_parser.add_argument('--curve', choices=('spike', 'uniform', 'staggered'), default='spike',
+                              help='spike: power restore; uniform: spread over the window; staggered: rolling reboot in batches')
+    storm_parser.add_argument('--window', type=float, default=5, help='Seconds over which phones (or each batch) power up')
+    storm_parser.add_argument('--batch', type=int, default=50, help='Phones per batch for the staggered curve')
+    storm_parser.add_argument('--interval', type=float, default=30, help='Seconds between batches for the staggered curve')
+    storm_parser.add_argument('--concurrency', type=int, default=200, help='Most phones booting at the same time')
+    storm_parser.add_argument('--firmware', action='append', default=[],
+                              help='Static path every phone fetches after its configs, may use {brand}, {model} and {mac}')
+    storm_parser.add_argument('--retries', type=int, default=2, help='Retries of 429 and 503 responses per file')
+    storm_parser.add_argument('--url', help='Replay against this server over HTTP instead of in-process')
+    storm_parser.add_argument('--app', choices=('full', 'provisioning'), default='full', help='Application used in-process')
+    storm_parser.add_argument('--seed', type=int)
+    storm_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    analyze_parser = subparsers.add_parser('analyze', help='Report the render cost of every template file for the phone list')
+    analyze_parser.add_argument('--templates', default=TEMPLATES_FOLDER, help='Templates folder to render (default: the installed one)')
+    analyze_parser.add_argument('--compare', help='Second templates folder to render and compare against --templates')
+    analyze_parser.add_argument('--processes', type=int, help='Render processes (default: one per CPU)')
+    analyze_parser.add_argument('--live-pbx', action='store_true', help='Read secrets and the directory from FreePBX instead of making them up')
+    analyze_parser.add_argument('--save-pbx-snapshot', help='With --live-pbx, save the FreePBX data read to this file')
+    analyze_parser.add_argument('--pbx-snapshot', help='Read secrets and the directory from a file saved by --save-pbx-snapshot')
+    analyze_parser.add_argument('--top', type=int, help='Show only this many templates')
+    analyze_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(['serve'])
+
+    if args.command == 'export-bundle':
+        try:
+            manifest = export_bundle(args.path, args.base)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print('Wrote bundle {} ({} files{})'.format(manifest['version'], len(manifest['files']),
+                                                    ', delta of ' + manifest['base'] if manifest['base'] else ''))
+        return
+
+    if args.command == 'jobs':
+        start_job_runner(args.threads)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return
+
+    if args.command == 'analyze':
+        analyze_renders(args)
+        return
+
+    if args.command == 'storm':
+        simulate_storm(args)
+        return
+
+    if args.command == 'tftp-get':
+        try:
+            data = tftp_get(args.host, args.port, args.filename, args.blksize)
+        except IOError as e:
+            print(e)
+            sys.exit(1)
+        if args.output:
+            with open(args.output, 'wb') as out_file:
+                out_file.write(data)
+        else:
+            getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+        return
+
+    if args.command == 'tftp':
+        REPLICA_BUNDLE_DIR = args.bundle_dir
+        serve_tftp(args.host, args.port, get_replica_bundle if args.replica else None)
+        return
+
+    import prov_server
+    REPLICA_BUNDLE_DIR = args.bundle_dir
+    if args.no_warmup:
+        WARMUP = False
+    app = {
+        'full': application,
+        'provisioning': provisioning_application,
+        'replica': replica_application,
+    }[args.app]
+    source_getter = get_replica_bundle if args.app == 'replica' else get_provisioning_source
+    prov_server.serve(app, args.bind, args.threads, args.workers, args.timeout, on_reload=clear_caches,
+                      on_start=lambda: start_warm_up(source_getter, wait=True))
 
 if __name__ == '__main__':
-    from wsgiref.simple_server import make_server
-    srv = make_server('localhost', 8080, application)
-    #srv = make_server( '0.0.0.0', 8080, application )
-    srv.serve_forever()
+    main()
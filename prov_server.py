@@ -0,0 +1,358 @@
+# Prov
+# Copyright (C) 2022 Giancarlo DiMino
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Standard library WSGI server for running Prov without Apache
+
+Connections are handed to a fixed pool of worker threads, HTTP/1.1
+keep-alive is supported with chunked responses when the length is not
+known, and on POSIX the listening socket can be shared by several forked
+worker processes. SIGHUP reloads gracefully and SIGTERM/SIGINT stop after
+in-flight requests finish.
+"""
+import io
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+if sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from Queue import Queue
+    from urllib import unquote
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Queue
+    from urllib.parse import unquote
+
+REQUEST_TIMEOUT = 30
+KEEPALIVE_TIMEOUT = 5
+MAX_REQUEST_BODY = 10 * 1024 * 1024
+
+
+class WSGIRequestHandler(BaseHTTPRequestHandler):
+    """Runs the server's WSGI application for each request on a connection"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Prov'
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.connection.settimeout(self.server.keepalive_timeout)
+            self.handle_one_request()
+
+    def get_environ(self):
+        path, _sep, query = self.path.partition('?')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': self.headers.get('Content-Length', ''),
+            'REMOTE_ADDR': self.client_address[0],
+            'REMOTE_PORT': str(self.client_address[1]),
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.server.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for key, value in self.headers.items():
+            key = key.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ['HTTP_' + key] = value
+        return environ
+
+    def run_wsgi(self):
+        self.connection.settimeout(self.server.request_timeout)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            self.send_error(411)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_REQUEST_BODY:
+            self.send_error(413)
+            return
+        environ = self.get_environ()
+        environ['wsgi.input'] = io.BytesIO(self.rfile.read(length))
+
+        response = {'status': None, 'headers': None, 'sent': False, 'chunked': False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response['sent']:
+                raise exc_info[1]
+            response['status'] = status
+            response['headers'] = headers
+            return write
+
+        def send_headers():
+            code, _sep, reason = response['status'].partition(' ')
+            self.send_response(int(code), reason)
+            names = set()
+            for name, value in response['headers']:
+                names.add(name.lower())
+                self.send_header(name, value)
+            if 'content-length' not in names:
+                if self.request_version == 'HTTP/1.1' and self.command != 'HEAD':
+                    response['chunked'] = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                else:
+                    self.close_connection = True
+            if self.server.stopping or self.server.backlogged():
+                self.close_connection = True
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            response['sent'] = True
+
+        def write(data):
+            if not response['sent']:
+                send_headers()
+            if not data or self.command == 'HEAD':
+                return
+            if response['chunked']:
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+            else:
+                self.wfile.write(data)
+
+        try:
+            result = self.server.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+                if not response['sent']:
+                    send_headers()
+                if response['chunked']:
+                    self.wfile.write(b'0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as e:
+            if not isinstance(e, socket.error):
+                self.server.handle_error(self.request, self.client_address)
+            if response['sent'] or isinstance(e, socket.error):
+                self.close_connection = True
+            else:
+                self.send_error(500)
+        self.wfile.flush()
+
+    do_GET = do_POST = do_HEAD = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = run_wsgi
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer handing accepted connections to a fixed pool of threads
+
+    Idle keep-alive connections are closed early while connections are
+    waiting for a free thread.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, app, threads=16, request_timeout=REQUEST_TIMEOUT,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, multiprocess=False):
+        HTTPServer.__init__(self, address, WSGIRequestHandler)
+        self.app = app
+        self.threads = threads
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.multiprocess = multiprocess
+        self.stopping = False
+        self.pending = Queue()
+        self.workers = []
+
+    def start_workers(self):
+        self.stopping = False
+        self.workers = [threading.Thread(target=self.worker) for _i in range(self.threads)]
+        for t in self.workers:
+            t.daemon = True
+            t.start()
+
+    def stop_workers(self):
+        """Waits for the requests in progress to finish"""
+
+        self.stopping = True
+        for _t in self.workers:
+            self.pending.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+
+    def backlogged(self):
+        return not self.pending.empty()
+
+    def worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+
+def parse_bind(bind):
+    host, _sep, port = bind.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+def serve(app, bind='localhost:8080', threads=16, workers=1, request_timeout=REQUEST_TIMEOUT, on_reload=None,
+          on_start=None):
+    """Serves app until SIGTERM or SIGINT
+
+    :param app WSGI application
+    :param bind host:port to listen on
+    :type bind str
+    :param threads Worker threads per process
+    :type threads int
+    :param workers Processes sharing the listening socket, forked on POSIX only
+    :type workers int
+    :param request_timeout Seconds a request may wait on the client socket
+    :type request_timeout int
+    :param on_reload Called on SIGHUP in single process mode to drop caches.
+        With several workers, SIGHUP replaces them with freshly forked ones.
+    :param on_start Called in each worker process before it accepts requests
+    """
+
+    server = ThreadPoolHTTPServer(parse_bind(bind), app, threads, request_timeout,
+                                  multiprocess=workers > 1)
+    print('Serving on {}:{} with {} process(es) of {} threads'.format(
+        server.server_address[0], server.server_port, workers, threads))
+    if workers > 1 and hasattr(os, 'fork'):
+        Supervisor(server, workers, on_start).run()
+    else:
+        run_worker(server, on_reload, on_start)
+
+
+def run_worker(server, on_reload=None, on_start=None):
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    def reload(signum, frame):
+        if on_reload is not None:
+            on_reload()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload)
+    if on_start is not None:
+        on_start()
+    server.start_workers()
+    try:
+        server.serve_forever()
+    finally:
+        server.stop_workers()
+        server.server_close()
+
+
+class Supervisor(object):
+    """Keeps a number of forked worker processes serving one listening socket
+
+    SIGHUP forks a new set of workers and then stops the old set
+    gracefully, so no request is refused while reloading.
+    """
+
+    def __init__(self, server, workers, on_start=None):
+        self.server = server
+        self.workers = workers
+        self.on_start = on_start
+        self.children = set()
+        self.retiring = set()
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            status = 0
+            try:
+                run_worker(self.server, on_start=self.on_start)
+            except Exception:
+                status = 1
+            os._exit(status)
+        self.children.add(pid)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def reload(self, signum, frame):
+        self.reloading = True
+
+    def signal_children(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, _status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            self.retiring.discard(pid)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        while len(self.children) < self.workers:
+            self.spawn()
+        while not self.stopping:
+            time.sleep(0.5)
+            self.reap()
+            if self.reloading:
+                self.reloading = False
+                old = set(self.children)
+                self.children -= old
+                self.retiring |= old
+                while len(self.children) < self.workers:
+                    self.spawn()
+                self.signal_children(old)
+            while len(self.children) < self.workers and not self.stopping:
+                self.spawn()
+        self.signal_children(self.children | self.retiring)
+        while self.children or self.retiring:
+            time.sleep(0.1)
+            self.reap()
+        self.server.server_close()
@@ -0,0 +1,560 @@
+# Prov
+# Copyright (C) 2022 Giancarlo DiMino
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Boot-storm simulator replaying phone fetch sequences against Prov
+
+Every virtual phone fetches its model's common files, then its MAC file,
+then firmware and directory files, the way phones do after a power
+restore. Phones arrive along a spike or a staggered curve and are played
+against a WSGI application in-process or against a server over HTTP.
+"""
+import io
+import math
+import random
+import re
+import sys
+import threading
+import time
+if sys.version_info.major == 2:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+else:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+
+PHASES = ('common', 'mac', 'firmware', 'directory')
+SERVER_STEPS = ('lookup', 'backend', 'render', 'total')
+RETRY_STATUSES = (429, 503)
+MAX_RETRY_WAIT = 10
+REQUEST_TIMEOUT = 30
+
+
+class Unsupported(ValueError):
+    pass
+
+
+CLASS_ESCAPES = {'d': '0', 'w': 'a', 's': ' '}
+RE_GROUP = re.compile(r'\(\?P<(\w+)>')
+RE_COUNT = re.compile(r'\{(\d*)(,(\d*))?\}')
+
+
+def _escape(pattern, i):
+    """Returns (character, index after it) for the escape starting at pattern[i]"""
+
+    c = pattern[i + 1:i + 2]
+    if c in CLASS_ESCAPES:
+        return CLASS_ESCAPES[c], i + 2
+    if not c or c.isalnum():
+        raise Unsupported(pattern[i:i + 2])
+    return c, i + 2
+
+
+def _first_in_class(pattern, i):
+    """Returns (first character a [...] class allows, index after the class), i being just after the ["""
+
+    if pattern[i:i + 1] == '^':
+        raise Unsupported('[^')
+    if pattern[i:i + 1] == '\\':
+        first, j = _escape(pattern, i)
+    else:
+        first, j = pattern[i:i + 1], i + 1
+    while j < len(pattern) and pattern[j] != ']':
+        j += 2 if pattern[j] == '\\' else 1
+    if j >= len(pattern) or not first:
+        raise Unsupported('[')
+    return first, j + 1
+
+
+def _repeat(pattern, i):
+    """Returns (times to repeat the preceding item, index after the quantifier)"""
+
+    c = pattern[i:i + 1]
+    if c in ('?', '*', '+'):
+        count, i = 1, i + 1
+    else:
+        m = RE_COUNT.match(pattern, i)
+        if not m:
+            return 1, i
+        low = int(m.group(1) or 0)
+        if m.group(2) is None:
+            count = low
+        else:
+            count = low or (0 if m.group(3) == '0' else 1)
+        i = m.end()
+    if pattern[i:i + 1] == '?':
+        i += 1
+    return count, i
+
+
+def _skip_branch(pattern, i):
+    """Returns the index of the ) closing the group pattern[i] is in, or the end"""
+
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '[':
+            i = _first_in_class(pattern, i + 1)[1]
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            if not depth:
+                return i
+            depth -= 1
+        i += 1
+    return i
+
+
+def _build(pattern, i, mac):
+    """Builds text matched by pattern from i up to the end of the group it is in
+
+    Handles the forms urls files use: literals and escapes, [...] classes,
+    ., quantifiers, plain, non-capturing and named groups, (?#...) comments
+    and | (the first alternative is used). The (?P<mac>...) group becomes mac.
+
+    :return Tuple of (text, index of the closing ) or the end)
+    :raises Unsupported for anything else
+    """
+
+    out = []
+    while i < len(pattern):
+        c = pattern[i]
+        if c == ')':
+            break
+        if c == '|':
+            i = _skip_branch(pattern, i + 1)
+            break
+        if c in '^$':
+            i += 1
+            continue
+        if c == '(':
+            if pattern.startswith('(?#', i):
+                i = pattern.index(')', i) + 1
+                continue
+            name = None
+            m = RE_GROUP.match(pattern, i)
+            if m:
+                name, i = m.group(1), m.end()
+            elif pattern.startswith('(?:', i):
+                i += 3
+            elif pattern.startswith('(?', i):
+                raise Unsupported(pattern[i:i + 3])
+            else:
+                i += 1
+            item, i = _build(pattern, i, mac)
+            if pattern[i:i + 1] != ')':
+                raise Unsupported('(')
+            i += 1
+            if name == 'mac':
+                item = mac
+        elif c == '[':
+            item, i = _first_in_class(pattern, i + 1)
+        elif c == '\\':
+            item, i = _escape(pattern, i)
+        elif c == '.':
+            item, i = 'a', i + 1
+        elif c in '*+?{':
+            raise Unsupported(c)
+        else:
+            item, i = c, i + 1
+        count, i = _repeat(pattern, i)
+        out.append(item * count)
+    return ''.join(out), i
+
+
+def url_path(pattern, mac=''):
+    """Returns a request path matched by a urls pattern, or None
+
+    :param pattern Line of a model's urls file
+    :param mac Substituted for the (?P<mac>...) group, in whichever case matches
+    :return Path, or None when the pattern is too loose to turn into one
+    :rtype str
+    """
+
+    candidates = []
+    try:
+        for m in ((mac.lower(), mac.upper()) if mac else ('', )):
+            path, end = _build(pattern, 0, m)
+            if end != len(pattern):
+                raise Unsupported(')')
+            candidates.append(path)
+    except (Unsupported, ValueError):
+        return None
+    for path in candidates:
+        m = re.search(pattern, path)
+        if m and path.startswith('/') and (not mac or m.groupdict().get('mac', '').lower() == mac.lower()):
+            return path
+    return None
+
+
+def model_sequences(routes, comment_pattern, phonebook_template, has_phonebook=None, firmware=()):
+    """Returns {(brand, model): [(phase, path or path format)]} from urls files
+
+    MAC paths are kept as formats with a {mac} field, filled in per phone.
+    Firmware paths are formats with {brand}, {model} and {mac} fields.
+    """
+
+    sequences = {}
+    for brand, model, urls in routes:
+        common, macs, directory = [], [], []
+        for url in urls:
+            m = re.search(comment_pattern, url)
+            if not m:
+                continue
+            if '(?P<mac>' in url:
+                sample = url_path(url, '0' * 12)
+                if sample is not None:
+                    macs.append(('mac', url))
+            else:
+                path = url_path(url)
+                if path is None:
+                    continue
+                if m.group('templatefile') == phonebook_template:
+                    directory.append(('directory', path))
+                else:
+                    common.append(('common', path))
+        if not directory and has_phonebook is not None and has_phonebook(brand, model):
+            directory.append(('directory', '/phonebook/{}/{}'.format(brand, model)))
+        fw = [('firmware', f) for f in firmware]
+        sequences[(brand, model)] = common + macs + fw + directory
+    return sequences
+
+
+def phone_sequence(sequences, phone):
+    """Returns the [(phase, path)] a phone fetches while booting"""
+
+    brand, _sep, model = (phone.get('template') or '').partition('/')
+    fetches = []
+    for phase, path in sequences.get((brand, model), ()):
+        if phase == 'mac':
+            path = url_path(path, phone['mac'])
+        elif phase == 'firmware':
+            path = '/' + path.format(brand=brand, model=model, mac=phone['mac']).lstrip('/')
+        if path is not None:
+            fetches.append((phase, path))
+    return fetches
+
+
+def arrival_times(count, curve='spike', window=5.0, batch=50, interval=30.0, seed=None):
+    """Returns the second each virtual phone starts booting, sorted
+
+    spike: every phone powers up within window seconds, most of them early,
+    as after a power restore. uniform: spread evenly over window.
+    staggered: batches of batch phones, interval seconds apart, each batch
+    within window seconds, as in a scheduled rolling reboot.
+    """
+
+    rnd = random.Random(seed)
+    if curve == 'spike':
+        times = [min(rnd.expovariate(3.0 / window), window) if window else 0.0 for _i in range(count)]
+    elif curve == 'uniform':
+        times = [rnd.uniform(0, window) for _i in range(count)]
+    elif curve == 'staggered':
+        times = [(i // batch) * interval + rnd.uniform(0, window) for i in range(count)]
+    else:
+        raise ValueError('Unknown arrival curve {}'.format(curve))
+    return sorted(times)
+
+
+class WSGIClient(object):
+    """Fetches paths from a WSGI application in this process"""
+
+    def __init__(self, app, remote_addr):
+        self.app = app
+        self.remote_addr = remote_addr
+
+    def fetch(self, path):
+        """:return (status code, body bytes, headers dict)"""
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return lambda data: None
+
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'REMOTE_ADDR': self.remote_addr,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        result = self.app(environ, start_response)
+        size = 0
+        try:
+            for data in result:
+                size += len(data)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return int(response['status'].split()[0]), size, dict((k.lower(), v) for k, v in response['headers'])
+
+    def close(self):
+        pass
+
+
+class HTTPClient(object):
+    """Fetches paths over one keep-alive connection, reconnecting after errors"""
+
+    def __init__(self, base_url, timeout=REQUEST_TIMEOUT):
+        parts = urlsplit(base_url)
+        self.connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+
+    def fetch(self, path):
+        if self.connection is None:
+            self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            self.connection.request('GET', self.prefix + path)
+            r = self.connection.getresponse()
+            size = len(r.read())
+        except Exception:
+            self.close()
+            raise
+        if r.getheader('connection', '').lower() == 'close':
+            self.close()
+        return r.status, size, dict((k.lower(), v) for k, v in r.getheaders())
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def server_timings(headers):
+    """Returns {step: seconds} from a Server-Timing header, {} when there is none"""
+
+    timings = {}
+    for entry in headers.get('server-timing', '').split(','):
+        parts = [p.strip() for p in entry.split(';')]
+        for param in parts[1:]:
+            if param.startswith('dur='):
+                try:
+                    timings[parts[0]] = float(param[4:]) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class StormResult(object):
+    """Timings collected while replaying, safe to add to from many threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = dict((phase, []) for phase in PHASES)
+        self.server = dict((phase, {}) for phase in PHASES)
+        self.errors = dict((phase, 0) for phase in PHASES)
+        self.statuses = {}
+        self.retries = 0
+        self.bytes = 0
+        self.provisioned = []
+        self.failed = 0
+        self.late = []
+        self.started = None
+        self.finished = None
+
+    def request(self, phase, status, elapsed, size, server=None):
+        with self.lock:
+            self.requests[phase].append(elapsed)
+            for step, seconds in (server or {}).items():
+                self.server[phase].setdefault(step, []).append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += size
+            if status != 200:
+                self.errors[phase] += 1
+
+    def phone(self, ok, elapsed, late):
+        with self.lock:
+            if ok:
+                self.provisioned.append(elapsed)
+            else:
+                self.failed += 1
+            self.late.append(late)
+
+    def summary(self):
+        """Returns the report as a dict, times in seconds
+
+        Request times are client latencies, measured around each fetch, so they
+        include the network and any wait for a server thread as well as rendering.
+        Server times per step come from the responses' Server-Timing headers.
+        """
+
+        duration = (self.finished or time.time()) - self.started
+        total = sum(len(v) for v in self.requests.values())
+        errors = sum(self.errors.values())
+        phases = {}
+        for phase in PHASES:
+            times = self.requests[phase]
+            if times:
+                phases[phase] = {
+                    'requests': len(times),
+                    'errors': self.errors[phase],
+                    'p50': percentile(times, 50),
+                    'p90': percentile(times, 90),
+                    'p99': percentile(times, 99),
+                    'max': max(times),
+                    'server': dict((step, {'p50': percentile(values, 50), 'p99': percentile(values, 99)})
+                                   for step, values in self.server[phase].items()),
+                }
+        return {
+            'phones': len(self.provisioned) + self.failed,
+            'provisioned': len(self.provisioned),
+            'failed': self.failed,
+            'requests': total,
+            'errors': errors,
+            'error_rate': float(errors) / total if total else 0.0,
+            'retries': self.retries,
+            'statuses': dict((str(k), v) for k, v in self.statuses.items()),
+            'bytes': self.bytes,
+            'duration': duration,
+            'requests_per_second': total / duration if duration else 0.0,
+            'provisioned_time': dict((name, percentile(self.provisioned, p)) for name, p in
+                                     (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))),
+            'start_lag_max': max(self.late) if self.late else None,
+            'phases': phases,
+        }
+
+
+def boot_phone(client, fetches, result, retries=2):
+    """Fetches a phone's sequence in order, retrying 429 and 503 like phones do
+
+    :return True when every fetch ended with 200
+    """
+
+    ok = True
+    for phase, path in fetches:
+        for attempt in range(retries + 1):
+            started = time.time()
+            try:
+                status, size, headers = client.fetch(path)
+            except Exception:
+                status, size, headers = 0, 0, {}
+            result.request(phase, status, time.time() - started, size, server_timings(headers))
+            if status not in RETRY_STATUSES or attempt == retries:
+                break
+            with result.lock:
+                result.retries += 1
+            try:
+                wait = float(headers.get('retry-after', 1))
+            except ValueError:
+                wait = 1
+            time.sleep(min(wait, MAX_RETRY_WAIT))
+        if status != 200:
+            ok = False
+    return ok
+
+
+def run_storm(phones, arrivals, client_factory, concurrency=200, retries=2):
+    """Replays every phone's fetch sequence starting at its arrival time
+
+    :param phones [(phone dict, [(phase, path)])]
+    :param arrivals Seconds after the start at which each phone boots
+    :param client_factory Called with a phone's index, returns a client with fetch and close
+    :param concurrency Most phones booting at once; later phones start late when all are busy
+    :rtype StormResult
+    """
+
+    result = StormResult()
+    queue = list(zip(arrivals, range(len(phones))))
+    queue.reverse()
+    lock = threading.Lock()
+    result.started = time.time()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                arrival, i = queue.pop()
+            delay = result.started + arrival - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            started = time.time()
+            client = client_factory(i)
+            try:
+                ok = boot_phone(client, phones[i][1], result, retries)
+            finally:
+                client.close()
+            result.phone(ok, time.time() - started, started - result.started - arrival)
+
+    threads = [threading.Thread(target=worker) for _i in range(max(1, min(concurrency, len(phones))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    result.finished = time.time()
+    return result
+
+
+def format_summary(summary):
+    def ms(value):
+        return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+    lines = [
+        'Phones: {phones}, fully provisioned: {provisioned}, failed: {failed}'.format(**summary),
+        'Requests: {} in {:.1f}s ({:.1f}/s), errors: {} ({:.2%}), retries: {}'.format(
+            summary['requests'], summary['duration'], summary['requests_per_second'],
+            summary['errors'], summary['error_rate'], summary['retries']),
+        'Statuses: ' + ', '.join('{} x{}'.format(k, v) for k, v in sorted(summary['statuses'].items())),
+        'Time to fully provisioned: ' + ' '.join('{} {}'.format(k, ms(summary['provisioned_time'][k]))
+                                                 for k in ('p50', 'p90', 'p99', 'max')),
+        'Start lag while all concurrency slots were busy: up to ' + ms(summary['start_lag_max']),
+        '',
+        'Client latency per request, including the network and server queueing:',
+        '{:<10} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}'.format('phase', 'requests', 'errors', 'p50', 'p90', 'p99', 'max'),
+    ]
+    for phase in PHASES:
+        p = summary['phases'].get(phase)
+        if p:
+            lines.append('{:<10} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+                phase, p['requests'], p['errors'], ms(p['p50']), ms(p['p90']), ms(p['p99']), ms(p['max'])))
+    if any(p['server'] for p in summary['phases'].values()):
+        lines += [
+            '',
+            'Server time per request from Server-Timing, p50 / p99:',
+            '{:<10} '.format('phase') + ' '.join('{:>19}'.format(step) for step in SERVER_STEPS),
+        ]
+        for phase in PHASES:
+            p = summary['phases'].get(phase)
+            if p and p['server']:
+                lines.append('{:<10} '.format(phase) + ' '.join('{:>19}'.format(
+                    '{} / {}'.format(ms(p['server'][step]['p50']), ms(p['server'][step]['p99'])) if step in p['server'] else '-')
+                    for step in SERVER_STEPS))
+    return '\n'.join(lines)